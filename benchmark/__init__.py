@@ -0,0 +1,25 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import yaml
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def sandbox(config: Optional[dict] = None, workdir: Optional[Path] = None) -> Path:
+    """
+    chdir into a scratch directory holding config.yaml and the default templates,
+    must be called before anything imports `config`.
+    """
+    workdir = workdir or Path(tempfile.mkdtemp(prefix="clashprofile-bench-"))
+    (workdir / "data" / "template").mkdir(parents=True, exist_ok=True)
+    shutil.copytree(ROOT / "static", workdir / "static", dirs_exist_ok=True)
+    for template in (ROOT / "static" / "template").glob("*.yml"):
+        shutil.copy(template, workdir / "data" / "template" / f"{template.stem}.yaml")
+    config = config or {"subscribes": {}, "profiles": {}}
+    (workdir / "config.yaml").write_text(yaml.safe_dump(config, allow_unicode=True))
+    os.chdir(workdir)
+    return workdir
@@ -0,0 +1,206 @@
+"""
+End-to-end update and serving benchmark against a local stand-in upstream.
+
+Every combination of the sizes runs in its own process, results go out as JSON:
+
+    python -m benchmark.pipeline [--proxies 10,1000,10000] [--rulesets 1,50]
+        [--ruleset-size 10240,10485760] [--latency 0.05] [--rounds 2]
+        [--requests 500] [--concurrency 20] [--output result.json]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import yaml
+
+from benchmark import ROOT, sandbox
+from benchmark import upstream
+
+TEMPLATE = ROOT / "static" / "template" / "blacklist.yml"
+
+
+def template(url: str, rulesets: int, size: int) -> dict:
+    """the blacklist template with its rule providers replaced by synthetic ones"""
+    data = yaml.safe_load(TEMPLATE.read_text(encoding="utf-8"))
+    target = next(r for r in data["rules"] if r.startswith("RULE-SET")).split(",")[-1]
+    data["rule-providers"] = {
+        f"r{i}": {
+            "type": "http",
+            "behavior": "domain",
+            "url": f"{url}/ruleset/{i}/{size}",
+            "path": f"./ruleset/r{i}.yaml",
+            "interval": 86400,
+        }
+        for i in range(rulesets)
+    }
+    data["rules"] = [f"RULE-SET,r{i},{target}" for i in range(rulesets)] + [
+        rule for rule in data["rules"] if not rule.startswith("RULE-SET")
+    ]
+    return data
+
+
+def peak_rss() -> int:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentiles(costs: List[float]) -> Dict[str, float]:
+    costs = sorted(costs)
+    return {
+        f"p{p}": costs[min(len(costs) - 1, int(len(costs) * p / 100))]
+        for p in (50, 95, 99)
+    }
+
+
+async def hammer(client, url: str, requests: int, concurrency: int) -> Dict:
+    costs, size = [], 0
+    queue = iter(range(requests))
+
+    async def worker():
+        nonlocal size
+        for _ in queue:
+            start = time.perf_counter()
+            res = await client.get(url)
+            costs.append(time.perf_counter() - start)
+            size += res.num_bytes_downloaded
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    cost = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "seconds": cost,
+        "rps": requests / cost,
+        "bytes": size,
+        "latency": percentiles(costs),
+    }
+
+
+def run_case(case: Dict) -> Dict:
+    url = upstream.start(case["latency"])
+    workdir = sandbox(
+        {
+            "log_level": "WARNING",
+            "urlprefix": "bench",
+            "subscribes": {
+                "jms": {
+                    "type": "jms",
+                    "url": f"{url}/jms/{case['proxies']}",
+                    "counter": f"{url}/counter",
+                },
+                "sub": {"type": "ClashSub", "url": f"{url}/sub/{case['proxies']}"},
+            },
+            "profiles": {
+                "bench-jms": {"template": "bench", "subs": ["jms"]},
+                "bench-sub": {"template": "bench", "subs": ["sub"]},
+            },
+        }
+    )
+    (workdir / "data" / "template" / "bench.yaml").write_text(
+        yaml.safe_dump(
+            template(url, case["rulesets"], case["ruleset_size"]), allow_unicode=True
+        ),
+        encoding="utf-8",
+    )
+
+    from httpx import ASGITransport, AsyncClient
+    from loguru import logger
+
+    logger.remove()
+    import main
+    from client import client_manager
+    from serve import profile_cache
+    from subscribe import update
+
+    async def bench() -> Dict:
+        client_manager.open()
+        rounds = []
+        for _ in range(case["rounds"]):
+            start = time.perf_counter()
+            result = await update(force=True)
+            rounds.append(
+                {
+                    "seconds": time.perf_counter() - start,
+                    "stages": result.timings,
+                    "error": result.error,
+                    "peak_rss": peak_rss(),
+                }
+            )
+        await profile_cache.reload(main.config.profiles)
+        serving = {}
+        async with AsyncClient(
+            transport=ASGITransport(app=main.app), base_url="http://bench"
+        ) as client:
+            for name, path in (
+                ("profile", "/bench/profile/bench-sub.yaml"),
+                ("provider", "/bench/provider/r0.yaml"),
+            ):
+                serving[name] = await hammer(
+                    client, path, case["requests"], case["concurrency"]
+                )
+        await client_manager.aclose()
+        return {"updates": rounds, "serving": serving, "peak_rss": peak_rss()}
+
+    return dict(case, **asyncio.run(bench()))
+
+
+def sizes(value: str) -> List[int]:
+    return [int(size) for size in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proxies", type=sizes, default=[10, 1000, 10000])
+    parser.add_argument("--rulesets", type=sizes, default=[1, 50])
+    parser.add_argument("--ruleset-size", type=sizes, default=[10240])
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    results = []
+    for proxies, rulesets, size in itertools.product(
+        args.proxies, args.rulesets, args.ruleset_size
+    ):
+        case = {
+            "proxies": proxies,
+            "rulesets": rulesets,
+            "ruleset_size": size,
+            "latency": args.latency,
+            "rounds": args.rounds,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+        }
+        print(f"running {case}", file=sys.stderr)
+        out = subprocess.run(
+            [sys.executable, "-m", "benchmark.pipeline", "--case", json.dumps(case)],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        )
+        if out.returncode:
+            results.append(dict(case, error=out.stderr.strip().splitlines()[-1:]))
+        else:
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Parse and render time of the proxy models: trying every member of the Union and
+validating the rendered profile again, against dispatching on `type` and
+assembling the rendered profile from the validated parts.
+
+    python -m benchmark.proxy_model [--proxies 1000,5000,10000] [--repeat 3]
+"""
+import argparse
+import json
+
+from benchmark import sandbox
+from benchmark.yaml_engine import best, profile
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--proxies",
+        type=lambda v: [int(n) for n in v.split(",")],
+        default=[1000, 5000, 10000],
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sandbox()
+    from typing import List, Union
+
+    from pydantic import parse_obj_as
+
+    from clash import SS, SSR, Clash, ClashTemplate, Proxy, Snell, Socks5, Trojan, Vmess
+
+    template = ClashTemplate.load("blacklist")
+    results = {}
+    for count in args.proxies:
+        data = profile(count, 0)
+        proxies = parse_obj_as(List[Proxy], data["proxies"])
+
+        def render_revalidate():
+            rendered = template.dict(exclude_none=True, by_alias=True)
+            names = [proxy.name for proxy in proxies]
+            for group in rendered["proxy-groups"]:
+                if group["proxies"] == "__proxies_name_list__":
+                    group["proxies"] = names
+            rendered["proxies"] = [
+                p.dict(exclude_none=True, by_alias=True) for p in proxies
+            ]
+            return Clash.parse_obj(rendered)
+
+        results[count] = {
+            "parse": {
+                "profile": best(lambda: Clash.parse_obj(data).proxies, args.repeat),
+                "union": best(
+                    lambda: parse_obj_as(
+                        List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]],
+                        data["proxies"],
+                    ),
+                    args.repeat,
+                ),
+                "discriminated": best(
+                    lambda: parse_obj_as(List[Proxy], data["proxies"]), args.repeat
+                ),
+            },
+            "render": {
+                "revalidate": best(render_revalidate, args.repeat),
+                "construct": best(lambda: template.render(proxies), args.repeat),
+            },
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
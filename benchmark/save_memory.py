@@ -0,0 +1,59 @@
+"""
+Peak memory of Clash.save against dumping the whole profile at once.
+
+    python -m benchmark.save_memory [--proxies 10000] [--rules 50000]
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from benchmark import sandbox
+from benchmark.yaml_engine import profile
+
+
+def measure(func) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    cost = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": cost, "peak_bytes": peak}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proxies", type=int, default=10000)
+    parser.add_argument("--rules", type=int, default=50000)
+    args = parser.parse_args()
+
+    workdir = sandbox()
+    import serializer
+    from clash import Clash
+    from storage import atomic_write
+
+    clash = Clash.parse_obj(profile(args.proxies, args.rules))
+    whole, streamed = workdir / "whole.yaml", workdir / "streamed.yaml"
+
+    def dump_whole():
+        atomic_write(
+            whole,
+            serializer.dump(
+                clash.dict(exclude_none=True, by_alias=True, exclude_unset=True),
+                sort_keys=False,
+                allow_unicode=True,
+            ).encode("utf-8"),
+        )
+
+    results = {
+        "engine": serializer.engine(),
+        "whole": measure(dump_whole),
+        "streamed": measure(lambda: clash.save(streamed)),
+    }
+    results["identical"] = whole.read_bytes() == streamed.read_bytes()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
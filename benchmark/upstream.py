@@ -0,0 +1,110 @@
+"""
+Stand-in for the upstream hosts: synthetic subscriptions, counters and rulesets
+of any size, served with an optional latency and ETags.
+
+    /jms/<proxies>            base64 Just My Socks subscription
+    /sub/<proxies>            Clash subscription
+    /counter                  Just My Socks counter
+    /ruleset/<index>/<bytes>  ruleset of about <bytes> bytes
+"""
+import base64
+import hashlib
+import json
+import multiprocessing
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+from benchmark.yaml_engine import profile
+
+
+def jms(proxies: int) -> bytes:
+    lines = []
+    for i in range(proxies):
+        userinfo = base64.b64encode(f"aes-256-gcm:password@s{i}:1".encode()).decode()
+        lines.append(f"ss://{userinfo}#JMS@s{i}.example.com:{10000 + i % 50000}")
+    return base64.encodebytes("\n".join(lines).encode())
+
+
+def sub(proxies: int) -> bytes:
+    """a whole Clash profile, as served by the providers"""
+    return yaml.safe_dump(
+        profile(proxies, 0), allow_unicode=True, sort_keys=False
+    ).encode()
+
+
+def counter() -> bytes:
+    return json.dumps(
+        {
+            "bw_counter_b": 1 << 30,
+            "monthly_bw_limit_b": 1 << 40,
+            "bw_reset_day_of_month": 1,
+        }
+    ).encode()
+
+
+def ruleset(index: int, size: int) -> bytes:
+    lines, total, i = ["payload:"], 0, 0
+    while total < size:
+        line = f"  - '+.r{index}-d{i}.example.com'"
+        lines.append(line)
+        total += len(line) + 1
+        i += 1
+    return "\n".join(lines).encode()
+
+
+@lru_cache(maxsize=None)
+def body(path: str) -> bytes:
+    parts = path.strip("/").split("/")
+    if parts[0] == "jms":
+        return jms(int(parts[1]))
+    if parts[0] == "sub":
+        return sub(int(parts[1]))
+    if parts[0] == "counter":
+        return counter()
+    if parts[0] == "ruleset":
+        return ruleset(int(parts[1]), int(parts[2]))
+    raise KeyError(path)
+
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        try:
+            content = body(self.path)
+        except (KeyError, IndexError, ValueError):
+            self.send_error(404)
+            return
+        etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        if self.headers.get("if-none-match") == etag:
+            self.send_response(304)
+            self.send_header("etag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("etag", etag)
+        self.send_header("content-length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(latency: float, ports) -> None:
+    Handler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start(latency: float = 0.0) -> str:
+    """serve in a child process so it doesn't add to the measured CPU and memory"""
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(latency, ports), daemon=True)
+    process.start()
+    return f"http://127.0.0.1:{ports.get()}"
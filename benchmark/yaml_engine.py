@@ -0,0 +1,71 @@
+"""
+Compare load / dump time of the available YAML engines on a realistic profile.
+
+    python -m benchmark.yaml_engine [--proxies 5000] [--rules 20000] [--repeat 3]
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import serializer
+
+TEMPLATE = Path("static/template/blacklist.yml")
+
+
+def proxy(i: int) -> dict:
+    node = {"name": f"节点-{i}", "server": f"s{i}.example.com", "port": 10000 + i % 50000}
+    if i % 2:
+        node.update(type="ss", cipher="aes-256-gcm", password="password", udp=True)
+    else:
+        node.update(type="vmess", uuid="uuid", alterId=0, cipher="auto", tls=True)
+    return node
+
+
+def profile(proxies: int, rules: int) -> dict:
+    data = serializer.load(TEMPLATE.read_bytes())
+    data["proxies"] = [proxy(i) for i in range(proxies)]
+    names = [proxy["name"] for proxy in data["proxies"]]
+    for group in data["proxy-groups"]:
+        if group["proxies"] == "__proxies_name_list__":
+            group["proxies"] = names
+    data["rules"] = [
+        f"DOMAIN-SUFFIX,d{i}.example.com,DIRECT" for i in range(rules)
+    ] + data["rules"]
+    return data
+
+
+def best(func, repeat: int) -> float:
+    costs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        costs.append(time.perf_counter() - start)
+    return min(costs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proxies", type=int, default=5000)
+    parser.add_argument("--rules", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data = profile(args.proxies, args.rules)
+    results = {}
+    for name in serializer.ENGINES:
+        serializer.use(name)
+        text = serializer.dump(data, sort_keys=False, allow_unicode=True)
+        results[name] = {
+            "dump": best(
+                lambda: serializer.dump(data, sort_keys=False, allow_unicode=True),
+                args.repeat,
+            ),
+            "load": best(lambda: serializer.load(text), args.repeat),
+            "bytes": len(text.encode()),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
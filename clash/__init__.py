@@ -1,13 +1,19 @@
+import hashlib
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, List, Literal, Optional, Sequence, Union
+from threading import Lock
+from typing import Dict, List, Literal, Optional, Sequence, Tuple, Union
 
-import yaml
+from loguru import logger
 from pydantic import BaseModel, Extra, Field, validator
 
-from clash.proxy import SS, SSR, Snell, Socks5, Trojan, Vmess
+import metrics
+import serializer
+from clash.proxy import SS, SSR, Proxy, Snell, Socks5, Trojan, Vmess
 from clash.proxygroup import ProxyGroup, ProxyGroupTemplate
 from clash.ruleprovider import RuleProvider
 from config import check_port
+from storage import atomic_open
 
 
 class ClashTemplate(BaseModel, extra=Extra.allow):
@@ -19,9 +25,7 @@ class ClashTemplate(BaseModel, extra=Extra.allow):
         alias="log-level"
     )
     external_controller: str = Field(alias="external-controller")
-    proxies: Union[
-        List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]], Literal["__proxies_list__"]
-    ]
+    proxies: Union[List[Proxy], Literal["__proxies_list__"]]
     proxy_groups: List[ProxyGroupTemplate] = Field(alias="proxy-groups")
     rule_providers: Optional[Dict[str, RuleProvider]] = Field(alias="rule-providers")
     rules: List[str]
@@ -29,16 +33,23 @@ class ClashTemplate(BaseModel, extra=Extra.allow):
     # validators
     _port = validator("port", allow_reuse=True)(check_port)
     _socks_port = validator("socks_port", allow_reuse=True)(check_port)
-    
-    @validator("mode","log_level",pre=True)
-    def to_lowercase(cls,v:str):
-        return v.lower() if isinstance(v,str) else v
+
+    @validator("mode", "log_level", pre=True)
+    def to_lowercase(cls, v: str):
+        return v.lower() if isinstance(v, str) else v
 
     @validator("rules")
     def check_rules(cls, rules: List[str], values):
+        # the proxy groups are invalid, their own errors are reported instead
+        if values.get("proxy_groups") is None:
+            return rules
         # collect infos
         pg_name = [pg.name for pg in values["proxy_groups"]] + ["DIRECT", "REJECT"]
-        rs_name = list(values["rule_providers"].keys()) if values["rule_providers"] else []
+        rs_name = (
+            list(values["rule_providers"].keys())
+            if values.get("rule_providers")
+            else []
+        )
         if not isinstance(rules, Sequence) or not rules:
             raise ValueError("rules is not Sequence or empty")
 
@@ -49,19 +60,35 @@ class ClashTemplate(BaseModel, extra=Extra.allow):
             # check proxy_groups
             if r[-1].upper() not in pg_name:
                 # except in some case
-                if r[-1].lower() == "no-resolve" and r[0].upper() in ["GEOIP", "IP-CIDR", "IP-CIDR6", "RULE-SET"] and r[-2] in pg_name:
+                if (
+                    r[-1].lower() == "no-resolve"
+                    and r[0].upper() in ["GEOIP", "IP-CIDR", "IP-CIDR6", "RULE-SET"]
+                    and r[-2] in pg_name
+                ):
                     continue
                 raise ValueError(f'Undefined proxy-groups "{r[-1]}"": {rule}')
             # check rule-set
             if r[0] == "RULE-SET" and r[1] not in rs_name:
                 raise ValueError(f'Undefined rule-providers "{r[1]}": {rule}')
             # check port
-            elif r[0] in ["SRC-PORT","DST-PORT"]:
-                if r[1].isdigit() and (int(r[1])<1 or int(r[1])>65535):
-                    raise ValueError(f"Port number must be in the range 0 to 65535, not {r[1]}: {rule}")
+            elif r[0] in ["SRC-PORT", "DST-PORT"]:
+                if r[1].isdigit() and (int(r[1]) < 1 or int(r[1]) > 65535):
+                    raise ValueError(
+                        f"Port number must be in the range 0 to 65535, not {r[1]}: {rule}"
+                    )
             # check remain keywords
-            elif r[0] in ["DOMAIN","DOMAIN-SUFFIX","DOMAIN-KEYWORD","GEOIP","IP-CIDR","IP-CIDR6","SRC-IP-CIDR","PROCESS-NAME","RULE-SET"]:
-                continue 
+            elif r[0] in [
+                "DOMAIN",
+                "DOMAIN-SUFFIX",
+                "DOMAIN-KEYWORD",
+                "GEOIP",
+                "IP-CIDR",
+                "IP-CIDR6",
+                "SRC-IP-CIDR",
+                "PROCESS-NAME",
+                "RULE-SET",
+            ]:
+                continue
             # check match
             elif r[0] == "MATCH":
                 if rule != rules[-1]:
@@ -69,43 +96,144 @@ class ClashTemplate(BaseModel, extra=Extra.allow):
                 has_match = True
             else:
                 raise ValueError(f"Illegal rule: {rule}")
-        if not has_match: raise ValueError("MATCH routes the rest of the packets to policy. This rule is required.")
+        if not has_match:
+            raise ValueError(
+                "MATCH routes the rest of the packets to policy. This rule is required."
+            )
         return rules
 
     @classmethod
     def load(cls, file: str) -> "ClashTemplate":
-        return cls.parse_obj(
-            yaml.load(
-                Path(f"data/template/{file}.yaml").read_bytes(), Loader=yaml.FullLoader
-            )
-        )
+        return templates.get(file)
 
     def render(
-        self, proxies: List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]]
+        self,
+        proxies: List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]],
+        top: Optional[int] = None,
+        sources: Optional[List[str]] = None,
     ) -> "Clash":
-        if not proxies: return Clash.parse_obj(self.dict(exclude_none=True, by_alias=True))
+        """
+        fill the proxies into a new Clash, the template itself is left untouched.
+        Both the template and the proxies are validated already, so the Clash is
+        assembled from them as they are instead of being validated once more.
+        The groups listing every proxy get only the ones passing their filter, and
+        only the first `top` of them if given. `sources` is the subscribe of every
+        proxy, for the filters on it.
+        """
+        if not proxies:
+            return Clash.parse_obj(self.dict(exclude_none=True, by_alias=True))
         proxies_name_list = [proxy.name for proxy in proxies]
-        proxy_groups = []
-        for group in self.proxy_groups:
-            if group.proxies == "__proxies_name_list__":
-                group.proxies = proxies_name_list
-            proxy_groups.append(group)
+        filters = [
+            (i, group.filter)
+            for i, group in enumerate(self.proxy_groups)
+            if group.filter is not None
+        ]
+        filtered: Dict[int, List[str]] = {i: [] for i, _ in filters}
+        if filters:
+            # every filter in a single pass over the proxies
+            for proxy, source in zip(proxies, sources or repeat(None)):
+                for i, proxy_filter in filters:
+                    if proxy_filter.match(proxy, source):
+                        filtered[i].append(proxy.name)
+
+        def group_proxies(i: int, group: ProxyGroupTemplate) -> List[str]:
+            if group.proxies != "__proxies_name_list__":
+                return group.proxies
+            if group.filter is None:
+                return proxies_name_list[:top]
+            if not filtered[i]:
+                logger.warning(f'No proxy passes the filter of group "{group.name}"')
+                return ["DIRECT"]
+            return filtered[i][:top]
+
+        values = dict(self.__dict__, proxies=list(proxies))
+        values["proxy_groups"] = [
+            ProxyGroup.construct(
+                group.__fields_set__,
+                **dict(group.__dict__, proxies=group_proxies(i, group)),
+            )
+            for i, group in enumerate(self.proxy_groups)
+        ]
+        if self.rule_providers:
+            # the urls are rewritten per profile
+            values["rule_providers"] = {
+                name: provider.copy() for name, provider in self.rule_providers.items()
+            }
+        return Clash.construct(
+            {key for key, value in values.items() if value is not None}, **values
+        )
+
+
+class TemplateRegistry:
+    """Validated templates cached by path, invalidated by mtime / size and content"""
 
-        self.proxies = proxies
-        self.proxy_groups = proxy_groups
-        return Clash.parse_obj(self.dict(exclude_none=True, by_alias=True))
+    def __init__(self, path: Path = Path("data/template")) -> None:
+        self.path = path
+        self._cache: Dict[str, Tuple[Tuple[int, int], str, ClashTemplate]] = {}
+        self._lock = Lock()
+
+    def _file(self, name: str) -> Path:
+        return self.path / f"{name}.yaml"
+
+    def get(self, name: str) -> ClashTemplate:
+        return self.load(name)[0]
+
+    def load(self, name: str) -> Tuple[ClashTemplate, str]:
+        """the template together with the hash of the content it was loaded from"""
+        file = self._file(name)
+        stat = file.stat()
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(name)
+        if cached and cached[0] == key:
+            metrics.cache_hits.inc(cache="template")
+            return cached[2], cached[1]
+
+        metrics.cache_misses.inc(cache="template")
+        content = file.read_bytes()
+        digest = hashlib.sha256(content).hexdigest()
+        if cached and cached[1] == digest:
+            # touched but not changed
+            template = cached[2]
+        else:
+            logger.debug(f"Loading template {name}")
+            template = ClashTemplate.parse_obj(serializer.load(content))
+        with self._lock:
+            self._cache[name] = (key, digest, template)
+        return template, digest
+
+
+templates = TemplateRegistry()
 
 
 class Clash(ClashTemplate):
-    proxies: List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]]
+    proxies: List[Proxy]
     proxy_groups: List[ProxyGroup] = Field(alias="proxy-groups")
 
-    def save(self, file: str) -> None:
-        Path(f"data/profile/{file}.yaml").write_text(
-            yaml.dump(
-                self.dict(exclude_none=True, by_alias=True,exclude_unset=True),
-                sort_keys=False,
-                allow_unicode=True,
-            ),
-            encoding="utf-8",
-        )
+    def save(self, file: Path) -> None:
+        """emit the profile section by section straight into the file"""
+        options = dict(exclude_none=True, by_alias=True, exclude_unset=True)
+        # the items are shared with the subscribes, where the defaults are left unset
+        item_options = dict(exclude_none=True, by_alias=True)
+        with atomic_open(file) as f:
+            for key, value in self.__dict__.items():
+                if key not in self.__fields_set__ or value is None:
+                    continue
+                if key in STREAMED_SECTIONS and value:
+                    f.write(f"{self.__fields__[key].alias}:\n".encode())
+                    for i in range(0, len(value), SAVE_CHUNK_SIZE):
+                        chunk = value[i : i + SAVE_CHUNK_SIZE]
+                        if key != "rules":
+                            chunk = [item.dict(**item_options) for item in chunk]
+                        self._dump(chunk, f)
+                else:
+                    self._dump(self.dict(include={key}, **options), f)
+
+    @staticmethod
+    def _dump(data, f) -> None:
+        serializer.dump(data, f, sort_keys=False, allow_unicode=True, encoding="utf-8")
+
+
+# big sequences written by Clash.save in chunks of SAVE_CHUNK_SIZE items
+STREAMED_SECTIONS = ("proxies", "proxy_groups", "rules")
+SAVE_CHUNK_SIZE = 256
@@ -1,6 +1,7 @@
-from typing import Literal, Optional
+from typing import Dict, Literal, Optional, Type, Union
 
 from pydantic import BaseModel, Extra, Field, validator
+from typing_extensions import Annotated
 
 from config import check_port
 
@@ -99,3 +100,13 @@ class Trojan(BaseModel, extra=Extra.allow):
 
     # validators
     _port = validator("port", allow_reuse=True)(check_port)
+
+
+# dispatch on `type` instead of trying every member of the Union in turn
+Proxy = Annotated[
+    Union[SS, SSR, Vmess, Socks5, Snell, Trojan], Field(discriminator="type")
+]
+PROXY_MODELS: Dict[str, Type[BaseModel]] = {
+    model.__fields__["type"].default: model
+    for model in (SS, SSR, Vmess, Socks5, Snell, Trojan)
+}
@@ -1,6 +1,39 @@
-from typing import Literal, Optional, Union, List
+from typing import Literal, Optional, Pattern, Set, Tuple, Union, List
 
-from pydantic import BaseModel, Extra, validator
+from pydantic import BaseModel, Extra, Field, validator
+
+
+class ProxyFilter(BaseModel, extra=Extra.forbid):
+    """
+    Which proxies a group listing every proxy gets, every condition given must
+    hold. Compiled once as the template is validated.
+    """
+
+    # regex searched in the name, and the one the name must not match
+    name: Optional[Pattern] = None
+    exclude: Optional[Pattern] = None
+    type: Optional[Set[str]] = None
+    # suffix of the server, like .hk or example.com
+    server: Optional[Tuple[str, ...]] = None
+    # name of the subscribe the proxy comes from
+    sub: Optional[Set[str]] = None
+
+    @validator("type", "server", "sub", pre=True)
+    def to_list(cls, v):
+        return [v] if isinstance(v, str) else v
+
+    @validator("server")
+    def to_lowercase(cls, v: Optional[Tuple[str, ...]]):
+        return tuple(suffix.lower() for suffix in v) if v is not None else v
+
+    def match(self, proxy: BaseModel, sub: Optional[str] = None) -> bool:
+        return (
+            (self.type is None or proxy.type in self.type)
+            and (self.sub is None or sub in self.sub)
+            and (self.server is None or proxy.server.lower().endswith(self.server))
+            and (self.name is None or self.name.search(proxy.name) is not None)
+            and (self.exclude is None or self.exclude.search(proxy.name) is None)
+        )
 
 
 class ProxyGroupTemplate(BaseModel, extra=Extra.allow):
@@ -9,6 +42,8 @@ class ProxyGroupTemplate(BaseModel, extra=Extra.allow):
     proxies: Union[List[str], Literal["__proxies_name_list__"]]
     url: Optional[str]
     interval: Optional[int]
+    # only for __proxies_name_list__, never written into the profile
+    filter: Optional[ProxyFilter] = Field(exclude=True)
     _index: Optional[int]
 
     @validator("url", "interval")
@@ -21,6 +56,12 @@ class ProxyGroupTemplate(BaseModel, extra=Extra.allow):
             )
         return v
 
+    @validator("filter")
+    def check_filter(cls, v, values):
+        if v is not None and values.get("proxies") != "__proxies_name_list__":
+            raise ValueError('filter only works with "__proxies_name_list__"')
+        return v
+
 
 class ProxyGroup(ProxyGroupTemplate):
-    proxies: List[str]
\ No newline at end of file
+    proxies: List[str]
@@ -6,4 +6,4 @@ class RuleProvider(BaseModel, extra=Extra.allow):
     behavior: str
     url: str
     path: str
-    interval: int
\ No newline at end of file
+    interval: int
@@ -0,0 +1,64 @@
+import asyncio
+import importlib.util
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from httpx import AsyncClient, Limits, Timeout
+from loguru import logger
+
+from config import config
+
+
+class ClientManager:
+    """Application-scoped httpx client shared by every download and counter"""
+
+    def __init__(self) -> None:
+        self._client: Optional[AsyncClient] = None
+        self._host_sems: Dict[str, asyncio.Semaphore] = {}
+
+    @staticmethod
+    def _http2() -> bool:
+        if not config.download_http2:
+            return False
+        if importlib.util.find_spec("h2") is None:
+            logger.debug("h2 is not installed, fall back to HTTP/1.1")
+            return False
+        return True
+
+    def open(self) -> AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = AsyncClient(
+                http2=self._http2(),
+                timeout=Timeout(
+                    config.download_read_timeout,
+                    connect=config.download_connect_timeout,
+                ),
+                limits=Limits(
+                    max_connections=config.download_max_connections,
+                    max_keepalive_connections=config.download_max_connections,
+                    keepalive_expiry=config.download_keepalive_expiry,
+                ),
+            )
+        return self._client
+
+    @property
+    def client(self) -> AsyncClient:
+        return self.open()
+
+    def host_sem(self, url: str) -> asyncio.Semaphore:
+        """limit the number of concurrent requests sent to one host"""
+        host = urlsplit(url).netloc
+        if host not in self._host_sems:
+            self._host_sems[host] = asyncio.Semaphore(
+                config.download_max_connections_per_host
+            )
+        return self._host_sems[host]
+
+    async def aclose(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._host_sems.clear()
+
+
+client_manager = ClientManager()
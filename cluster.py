@@ -0,0 +1,93 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from loguru import logger
+
+from storage import DATA_PATH, atomic_write
+from utils import CACHE_PATH
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+LEADER_LOCK = DATA_PATH / "leader.lock"
+REQUESTS_PATH = CACHE_PATH / "update-requests"
+STATUS_FILE = CACHE_PATH / "status.json"
+
+
+def _read_json(file: Path) -> Optional[Dict]:
+    try:
+        return json.loads(file.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class Cluster:
+    """
+    The workers serving the same data/ folder. The one holding the lock file is
+    the leader and runs every update, the others only serve what it commits and
+    hand the manual updates over to it through files under data/cache/.
+    """
+
+    def __init__(self, lock: Path = LEADER_LOCK) -> None:
+        self.lock = lock
+        self._fd: Optional[int] = None
+
+    @property
+    def leader(self) -> bool:
+        return self._fd is not None
+
+    def elect(self) -> bool:
+        """try to become the leader, return whether this worker is the leader"""
+        if self._fd is not None:
+            return True
+        if fcntl is None:
+            # no file locks on this platform, single worker only
+            self._fd = -1
+            return True
+        self.lock.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.lock, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        logger.info(f"Worker {os.getpid()} is elected as the leader")
+        return True
+
+    def resign(self) -> None:
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)
+        self._fd = None
+
+    # manual updates forwarded from the followers
+    def request_update(self, **request) -> str:
+        id = uuid4().hex
+        atomic_write(REQUESTS_PATH / f"{id}.json", json.dumps(request).encode())
+        return id
+
+    def take_requests(self) -> List[Tuple[str, Dict]]:
+        requests = []
+        for file in sorted(REQUESTS_PATH.glob("*.json")):
+            requests.append((file.stem, _read_json(file) or {}))
+            file.unlink(missing_ok=True)
+        return requests
+
+    # update status shared with the followers
+    @staticmethod
+    def publish_status(status: Dict) -> None:
+        atomic_write(STATUS_FILE, json.dumps(status, default=str).encode())
+
+    @staticmethod
+    def read_status() -> Optional[Dict]:
+        return _read_json(STATUS_FILE)
+
+
+cluster = Cluster()
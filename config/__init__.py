@@ -1,35 +1,80 @@
 import json
 from pathlib import Path
-from typing import Dict, List, Literal, Union
+from typing import Dict, List, Literal, Optional, Union
 
-import yaml
 from pydantic import BaseModel, Extra, validator
 
-from config.subscribe import JMS, ClashFile, ClashSub
-from config.tools import check_port, check_timezone
+import serializer
+from config.subscribe import JMS, ClashFile, ClashSub, Refresh
+from config.tools import check_cron, check_interval, check_port, check_timezone
 
 DEFUALT_CONFIG_PATH = Path("config.yaml")
 
 
-class Profile(BaseModel):
+class Profile(Refresh):
     template: str
     subs: List[str] = []
+    # arranged by the probe results, needs probe enabled
+    drop_unreachable: bool = False
+    sort_by_latency: bool = False
+    # cap the groups listing every proxy at the first n of them
+    top_proxies: Optional[int] = None
+
+    @validator("top_proxies")
+    def check_top_proxies(cls, v: Optional[int]):
+        if v is not None and v < 1:
+            raise ValueError("top_proxies must be at least 1")
+        return v
 
 
 class Config(BaseModel, extra=Extra.ignore):
     log_level: Literal[
         "TRACE", "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"
     ] = "INFO"
+    yaml_engine: Literal["auto", "libyaml", "pyyaml"] = "auto"
 
     download_sem: int = 4
     download_retry: int = 3
+    download_max_connections: int = 20
+    download_max_connections_per_host: int = 4
+    download_keepalive_expiry: float = 30
+    download_http2: bool = True
+    download_connect_timeout: float = 10
+    download_read_timeout: float = 60
+    download_backoff_base: float = 1
+    download_backoff_max: float = 30
+    breaker_threshold: int = 5
+    breaker_cooldown: float = 60
+    download_max_size: int = 0
+    download_max_sizes: Dict[str, int] = {}
+
+    render_executor: Literal["thread", "process"] = "thread"
+    render_workers: int = 2
+    parse_cache_size: int = 64 * 1024 * 1024
+
+    probe: bool = False
+    probe_concurrency: int = 64
+    probe_timeout: float = 3
+    probe_tls: bool = False
+    probe_ttl: int = 600
 
     update_cron: str = "35 6 * * *"
     update_tz: str = "Asia/Shanghai"
+    ruleset_cron: Optional[str] = None
+    ruleset_interval: Optional[int] = None
+    watch_templates: bool = True
+    watch_interval: float = 5
+    generations: int = 0
+    startup_update: Literal["blocking", "background"] = "background"
+
+    counter_ttl: int = 300
+    counter_fallback: bool = True
 
     domian: str = "http://0.0.0.0:46199"
     host: str = "0.0.0.0"
     port: int = 46199
+    workers: int = 1
+    cluster_poll_interval: float = 2
     urlprefix: str = "/path/to/mess/url"
     headers: Dict[str, str] = {"profile-update-interval": "24"}
 
@@ -39,6 +84,8 @@ class Config(BaseModel, extra=Extra.ignore):
     # validators
     _port = validator("port", allow_reuse=True)(check_port)
     _tz = validator("update_tz", allow_reuse=True)(check_timezone)
+    _ruleset_cron = validator("ruleset_cron", allow_reuse=True)(check_cron)
+    _ruleset_interval = validator("ruleset_interval", allow_reuse=True)(check_interval)
 
     @validator("urlprefix", "domian", pre=True)
     def format_urlprefix(cls, v: str):
@@ -75,15 +122,16 @@ class Config(BaseModel, extra=Extra.ignore):
         if not file.exists():
             cls._create_file(file)
             raise FileNotFoundError
-        return cls.parse_obj(yaml.load(file.read_bytes(), Loader=yaml.FullLoader))
+        return cls.parse_obj(serializer.load(file.read_bytes()))
 
     def save(self, file: Path = DEFUALT_CONFIG_PATH):
         if not file.exists():
             self._create_file(file)
         file.write_text(
-            yaml.dump(self.dict(by_alias=True), sort_keys=False),
+            serializer.dump(self.dict(by_alias=True), sort_keys=False),
             encoding="utf-8",
         )
 
 
 config: Config = Config.load()
+serializer.use(config.yaml_engine)
@@ -1,9 +1,20 @@
 from typing import Literal, Optional
 from pydantic import BaseModel, Extra, validator
-from config.tools import check_timezone
+from config.tools import check_cron, check_interval, check_timezone
 
 
-class Subscribe(BaseModel, extra=Extra.allow):
+class Refresh(BaseModel):
+    """own refresh schedule, on top of the global update_cron"""
+
+    cron: Optional[str] = None
+    interval: Optional[int] = None
+
+    # validators
+    _cron = validator("cron", allow_reuse=True)(check_cron)
+    _interval = validator("interval", allow_reuse=True)(check_interval)
+
+
+class Subscribe(Refresh, extra=Extra.allow):
     type: str
     subtz: Optional[str] = "Asia/Shanghai"
 
@@ -24,9 +35,12 @@ class ClashSub(Subscribe):
 
     type: Literal["ClashSub"] = "ClashSub"
     url: str
-    
+
 
 class ClashFile(Subscribe):
     """Generic clash profile on local disk"""
+
     type: Literal["ClashFile"] = "ClashFile"
     file: str
+    # refresh as soon as the file changes
+    watch: bool = True
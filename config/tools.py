@@ -1,13 +1,32 @@
+from apscheduler.triggers.cron import CronTrigger
 from pytz import timezone, UnknownTimeZoneError
 
+
 def check_port(p):
     if p > 65535 or p <= 0:
         raise ValueError(f"Port number must be in the range 0 to 65535, not {p}")
     return p
 
+
 def check_timezone(tz: str):
     try:
         timezone(tz)
     except UnknownTimeZoneError as e:
         raise ValueError(f"Timezone {tz} could not be resolved") from e
-    return tz
\ No newline at end of file
+    return tz
+
+
+def check_cron(cron):
+    if cron is None:
+        return cron
+    try:
+        CronTrigger.from_crontab(cron)
+    except ValueError as e:
+        raise ValueError(f"Crontab {cron} could not be resolved: {e}") from e
+    return cron
+
+
+def check_interval(interval):
+    if interval is not None and interval <= 0:
+        raise ValueError(f"Interval must be positive, not {interval}")
+    return interval
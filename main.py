@@ -1,77 +1,244 @@
+import asyncio
 import os
 import shutil
+import time
+from datetime import datetime
+from typing import List, Optional
 
 import uvicorn
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from fastapi import FastAPI, HTTPException
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Query, Request
 from loguru import logger
-from starlette.responses import FileResponse
+from starlette.responses import JSONResponse, Response
 
 # check dirs and files
 os.makedirs("data/profile", 0o777, True)
 os.makedirs("data/provider", 0o777, True)
 os.makedirs("data/template", 0o777, True)
+os.makedirs("data/cache", 0o777, True)
 if len(os.listdir("data/template")) == 0:
     shutil.copytree("static/template/", "data/template/", dirs_exist_ok=True)
-# remove old profiles
-for f in os.listdir("data/profile"):
-    os.remove(f"data/profile/{f}")
 
 
+import metrics
+from client import client_manager
+from cluster import cluster
 from config import config
 from log import LOGGING_CONFIG
-from subscribe import counter, update
+from retry import hosts
+from serve import profile_cache, provider_cache, respond, respond_file
+from storage import storage
+from subscribe import UpdateStatus, counter, status, warm
+from subscribe.jobs import Job, jobs, scope
+from subscribe.schedule import refresh
+from utils import shutdown_executor
 
 app = FastAPI()
 
+
+# latency and bytes served of the profile / provider downloads
+@app.middleware("http")
+async def observe(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    endpoint = request.url.path[len(config.urlprefix) + 2 :].split("/", 1)[0]
+    if endpoint in ("profile", "provider"):
+        metrics.request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+        metrics.response_bytes.inc(
+            int(response.headers.get("content-length") or 0), endpoint=endpoint
+        )
+        # revalidated by the client instead of downloaded again
+        if response.status_code == 304:
+            metrics.cache_hits.inc(cache=f"{endpoint}_etag")
+        elif response.status_code < 400:
+            metrics.cache_misses.inc(cache=f"{endpoint}_etag")
+    return response
+
+
 # provider download
-app.mount(f"/{config.urlprefix}/provider", StaticFiles(directory="data/provider"))
+@app.api_route(f"/{config.urlprefix}/provider" + "/{path}", methods=["GET", "HEAD"])
+async def provider(path: str, request: Request):
+    name = path.rsplit(".", 1)[0]
+    provider = None if path.startswith(".") else await provider_cache.get(name)
+    if provider is None:
+        raise HTTPException(404, f"Provider {path} not found")
+    return await respond_file(request, provider)
+
 
 # profile download
-@app.get(f"/{config.urlprefix}/profile" + "/{path}")
-async def profile(path: str):
-    path = path.rsplit(".",1)[0] + ".yaml"
+@app.api_route(f"/{config.urlprefix}/profile" + "/{path}", methods=["GET", "HEAD"])
+async def profile(path: str, request: Request):
+    path = path.rsplit(".", 1)[0] + ".yaml"
     logger.info(f"A request to download profile {path} was received")
     if path[:-5] not in config.profiles.keys():
         raise HTTPException(404, f"Profile {path} not found")
-    resp = FileResponse(
-        path=f"data/profile/{path}",
-    )
+    payload = profile_cache.get(path[:-5])
+    if payload is None:
+        raise HTTPException(404, f"Profile {path} is not generated yet")
+    headers = dict(config.headers)
     counter_info = await counter(path[:-5])
     if counter_info:
-        resp.headers["subscription-userinfo"] = counter_info
-    for h in config.headers:
-        resp.headers[h] = config.headers[h]
-    return resp
+        headers["subscription-userinfo"] = counter_info
+    return respond(request, payload, headers)
 
 
-# manual update trigger
-@app.get(f"/{config.urlprefix}/update")
-async def _():
+# manual update trigger, returns the job right away
+@app.get(f"/{config.urlprefix}/update", status_code=202)
+async def _(
+    force: bool = False,
+    profiles: Optional[List[str]] = Query(None),
+    subs: Optional[List[str]] = Query(None),
+    rulesets: Optional[bool] = None,
+):
     logger.info("Update is triggered manually")
-    error = await update()
-    return str(error) or "update complete"
+    unknown = [p for p in profiles or [] if p not in config.profiles] + [
+        s for s in subs or [] if s not in config.subscribes
+    ]
+    if unknown:
+        raise HTTPException(404, f"Profile(s) or subscribe(s) {unknown} not found")
+    request = dict(
+        force=force,
+        profiles=scope(profiles, subs),
+        # the profiles picked by name fetch all their subscribes again
+        subs=None if profiles else subs,
+        # rulesets are refreshed by the full updates only, unless asked for
+        rulesets=not (profiles or subs) if rulesets is None else rulesets,
+    )
+    if cluster.leader:
+        return jobs.submit(**request)
+    # only the leader updates, hand it over
+    trigger = cluster.request_update(**request)
+    job = Job(id=trigger, created=datetime.now(), **request)
+    jobs.save(job)
+    return job
 
 
-@app.on_event("startup")
-async def startup_event():
-    error = await update()
-    if error:
-        raise error
+# progress of an update job
+@app.get(f"/{config.urlprefix}/update" + "/{id}")
+async def _job(id: str):
+    job = jobs.get(id)
+    if job is None:
+        raise HTTPException(404, f"Job {id} not found")
+    return job
+
+
+# readiness check
+@app.get(f"/{config.urlprefix}/ready")
+async def ready():
+    return JSONResponse(
+        {
+            "fresh": status.fresh,
+            "running": status.running,
+            "serving": [p for p in config.profiles if storage.profile(p).is_file()],
+            "last_success": status.last_success and status.last_success.isoformat(),
+            "last_error": status.last_error,
+        },
+        status_code=200 if status.fresh else 503,
+    )
+
+
+# download stats per host
+@app.get(f"/{config.urlprefix}/hosts")
+async def _hosts():
+    return hosts.snapshot()
+
+
+# prometheus metrics
+@app.get(f"/{config.urlprefix}/metrics")
+async def _metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def publish(job: Job) -> None:
+    cluster.publish_status(status.dict())
+
+
+async def scheduled() -> None:
+    logger.info("Update is triggered by the scheduler")
+    jobs.submit()
+
+
+async def lead(blocking: bool = False):
+    """start the updates of this worker once it is elected as the leader"""
+    await warm()
+    job = jobs.submit()
+    if blocking:
+        job = await jobs.wait(job.id)
+        if job.result.error:
+            raise RuntimeError(job.result.error)
+    else:
+        persisted = [p for p in config.profiles if storage.profile(p).is_file()]
+        logger.info(
+            f"Serving {len(persisted)} persisted profile(s) "
+            "while the first update runs in background"
+        )
     logger.info(
         f"Starting up scheduler from crontab {config.update_cron} at timezone {config.update_tz}"
     )
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(
-        update, CronTrigger.from_crontab(config.update_cron, config.update_tz)
+    app.state.scheduler.add_job(
+        scheduled, CronTrigger.from_crontab(config.update_cron, config.update_tz)
     )
-    scheduler.start()
+    refresh.start(app.state.scheduler)
+
+
+def follow() -> None:
+    """pick up what the leader committed"""
+    storage.sync()
+    shared = cluster.read_status()
+    if shared is not None:
+        for key, value in UpdateStatus.parse_obj(shared):
+            setattr(status, key, value)
+
+
+async def watch():
+    while True:
+        await asyncio.sleep(config.cluster_poll_interval)
+        try:
+            if not cluster.leader and cluster.elect():
+                await lead()
+            if cluster.leader:
+                for trigger, request in cluster.take_requests():
+                    jobs.submit(trigger=trigger, **request)
+                jobs.checkpoint()
+            else:
+                follow()
+        except Exception as e:
+            logger.exception(f"Watching the cluster failed: {e}")
+
+
+@app.on_event("startup")
+async def startup_event():
+    client_manager.open()
+    await profile_cache.reload(config.profiles)
+    storage.on_commit(lambda: profile_cache.schedule_reload(config.profiles))
+    jobs.on_finish(publish)
+    app.state.scheduler = AsyncIOScheduler()
+    app.state.scheduler.start()
+    if cluster.elect():
+        await lead(config.startup_update == "blocking")
+    else:
+        logger.info(f"Worker {os.getpid()} follows the leader, serving only")
+        follow()
+    app.state.watch = asyncio.create_task(watch())
     logger.info(
         f"Application startup complete, listening requests from {config.domian}/{config.urlprefix}/"
     )
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.watch.cancel()
+    cluster.resign()
+    await client_manager.aclose()
+    shutdown_executor()
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host=config.host, port=config.port, log_config=LOGGING_CONFIG)
+    uvicorn.run(
+        app if config.workers == 1 else "main:app",
+        host=config.host,
+        port=config.port,
+        workers=config.workers,
+        log_config=LOGGING_CONFIG,
+    )
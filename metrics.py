@@ -0,0 +1,166 @@
+from threading import Lock
+from typing import Dict, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry: List["Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join(
+            [
+                f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.type}",
+            ]
+            + self.samples()
+        )
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_labels(self.labels, key)} {value}"
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # key -> (count per bucket, sum, count)
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self.values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket in zip(self.buckets, counts):
+                le = _labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {bucket}")
+            inf = _labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+def render() -> str:
+    """all metrics in the Prometheus text exposition format"""
+    for cache in cache_hits.values.keys() | cache_misses.values.keys():
+        hits, misses = cache_hits.get(cache=cache[0]), cache_misses.get(cache=cache[0])
+        cache_hit_ratio.set(
+            hits / (hits + misses) if hits + misses else 0, cache=cache[0]
+        )
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+upstream_fetch_seconds = Histogram(
+    "clashprofile_upstream_fetch_seconds",
+    "Latency of the requests sent to upstream hosts",
+    ["host", "kind"],
+)
+upstream_fetch_failures = Counter(
+    "clashprofile_upstream_fetch_failures_total",
+    "Failed attempts of the requests sent to upstream hosts",
+    ["host", "kind"],
+)
+update_stage_seconds = Histogram(
+    "clashprofile_update_stage_seconds",
+    "Wall time of every stage of an update",
+    ["stage"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+updates = Counter("clashprofile_updates_total", "Finished updates", ["result"])
+probes = Counter(
+    "clashprofile_probes_total", "Connectivity checks of the proxies", ["result"]
+)
+quarantined = Counter(
+    "clashprofile_quarantined_entries_total",
+    "Subscription entries skipped for failing to parse",
+    ["scheme"],
+)
+counter_lookups = Counter(
+    "clashprofile_counter_lookups_total",
+    "Lookups of subscription-userinfo from upstream",
+    ["result"],
+)
+request_seconds = Histogram(
+    "clashprofile_request_seconds", "Latency of the served requests", ["endpoint"]
+)
+response_bytes = Counter(
+    "clashprofile_response_bytes_total", "Bytes of the served responses", ["endpoint"]
+)
+profile_proxies = Gauge(
+    "clashprofile_profile_proxies", "Proxies in the last rendered profile", ["profile"]
+)
+cache_hits = Counter("clashprofile_cache_hits_total", "Cache hits", ["cache"])
+cache_misses = Counter("clashprofile_cache_misses_total", "Cache misses", ["cache"])
+cache_hit_ratio = Gauge(
+    "clashprofile_cache_hit_ratio", "Hits / (hits + misses) of the cache", ["cache"]
+)
@@ -0,0 +1,149 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from config import config
+
+# status codes worth another attempt
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """the url could not be downloaded"""
+
+
+class CircuitOpen(DownloadError):
+    """the host is known to be down, the request is not sent at all"""
+
+
+class RetryableStatus(Exception):
+    def __init__(self, status_code: int, retry_after: Optional[float] = None) -> None:
+        super().__init__(f"HTTP {status_code}")
+        self.retry_after = retry_after
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honouring Retry-After"""
+
+    def __init__(self, retries: int, base: float, cap: float) -> None:
+        self.retries = max(retries, 1)
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.cap)
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+    @staticmethod
+    def retry_after(value: Optional[str]) -> Optional[float]:
+        """seconds from a Retry-After header, either delta-seconds or an HTTP-date"""
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and fails fast for `cooldown`
+    seconds, then lets one request through to probe the host again.
+    """
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            return False
+        if self.state == "half-open":
+            # only one probe at a time, re-open until it reports back
+            self.opened_at = time.monotonic()
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.threshold and self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class HostStats:
+    def __init__(self) -> None:
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def success(self, latency: float) -> None:
+        self.successes += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def dict(self) -> Dict:
+        return {
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "latency_avg": self.latency_total / self.successes
+            if self.successes
+            else None,
+            "latency_max": self.latency_max,
+        }
+
+
+class Hosts:
+    """Circuit breaker and stats of every host we download from"""
+
+    def __init__(self) -> None:
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.stats: Dict[str, HostStats] = {}
+
+    @staticmethod
+    def host(url: str) -> str:
+        return urlsplit(url).netloc
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(
+                config.breaker_threshold, config.breaker_cooldown
+            )
+        return self.breakers[host]
+
+    def stat(self, host: str) -> HostStats:
+        if host not in self.stats:
+            self.stats[host] = HostStats()
+        return self.stats[host]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {
+            host: dict(stat.dict(), state=self.breaker(host).state)
+            for host, stat in self.stats.items()
+        }
+
+
+policy = RetryPolicy(
+    config.download_retry, config.download_backoff_base, config.download_backoff_max
+)
+hosts = Hosts()
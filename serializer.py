@@ -0,0 +1,41 @@
+from typing import IO, Any, Dict, Optional, Tuple, Type, Union
+
+import yaml
+from loguru import logger
+
+# name -> (Loader, Dumper)
+ENGINES: Dict[str, Tuple[Type, Type]] = {"pyyaml": (yaml.SafeLoader, yaml.SafeDumper)}
+if yaml.__with_libyaml__:
+    ENGINES["libyaml"] = (yaml.CSafeLoader, yaml.CSafeDumper)
+# libyaml loads much faster, but its emitter escapes emoji and the like, so the
+# profiles are dumped by the pure Python emitter unless libyaml is asked for
+ENGINES["auto"] = (ENGINES.get("libyaml", ENGINES["pyyaml"])[0], yaml.SafeDumper)
+
+_engine = "auto"
+
+
+def register(name: str, loader: Type, dumper: Type) -> None:
+    """make a Loader / Dumper pair available to use()"""
+    ENGINES[name] = (loader, dumper)
+
+
+def use(name: str = "auto") -> str:
+    """switch the YAML engine used by every load / dump, return the one in use"""
+    global _engine
+    if name not in ENGINES:
+        logger.warning(f"YAML engine {name} is not available, fall back to pyyaml")
+        name = "pyyaml"
+    _engine = name
+    return _engine
+
+
+def engine() -> str:
+    return _engine
+
+
+def load(stream: Union[str, bytes, IO]) -> Any:
+    return yaml.load(stream, Loader=ENGINES[_engine][0])
+
+
+def dump(data: Any, stream: Optional[IO] = None, **kwargs) -> Optional[str]:
+    return yaml.dump(data, stream, Dumper=ENGINES[_engine][1], **kwargs)
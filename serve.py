@@ -0,0 +1,316 @@
+import asyncio
+import gzip
+import hashlib
+from datetime import datetime
+from email.utils import formatdate
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from apscheduler.triggers.cron import CronTrigger
+from fastapi import Request
+from loguru import logger
+from pytz import timezone
+from starlette.responses import FileResponse, Response
+
+import metrics
+from config import config
+from storage import CHUNK_SIZE, ENCODINGS, storage
+from utils import run_sync
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+MEDIA_TYPE = "text/plain; charset=utf-8"
+# same as the precompressed files, quality 11 takes seconds for a big profile
+BROTLI_QUALITY = 9
+
+
+def negotiate(accept_encoding: str, available: Iterable[str]) -> str:
+    """choose the smallest variant the client accepts"""
+    prefs: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            prefs[coding] = q
+    for encoding in ("br", "gzip"):
+        if encoding in available and prefs.get(encoding, prefs.get("*", 0)) > 0:
+            return encoding
+    return "identity"
+
+
+def _etags(digest: str, encodings: Iterable[str]) -> Dict[str, str]:
+    return {
+        encoding: f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"'
+        for encoding in encodings
+    }
+
+
+class Payload:
+    """A file kept in memory together with its precompressed variants"""
+
+    def __init__(self, body: bytes, mtime: float, digest: Optional[str] = None) -> None:
+        self.digest = (
+            hashlib.sha256(body).hexdigest()[:32] if digest is None else digest
+        )
+        self.bodies: Dict[str, bytes] = {"identity": body}
+        self.bodies["gzip"] = gzip.compress(body, 9, mtime=0)
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+        self.etags = _etags(self.digest, self.bodies)
+        self.last_modified = formatdate(mtime, usegmt=True)
+
+
+def not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in [
+        tag[2:] if tag.startswith("W/") else tag for tag in tags
+    ]
+
+
+def respond(
+    request: Request,
+    payload: Payload,
+    headers: Optional[Mapping[str, str]] = None,
+    media_type: str = MEDIA_TYPE,
+) -> Response:
+    encoding = negotiate(request.headers.get("accept-encoding", ""), payload.bodies)
+    etag = payload.etags[encoding]
+    resp_headers = {
+        "etag": etag,
+        "last-modified": payload.last_modified,
+        "vary": "Accept-Encoding",
+    }
+    resp_headers.update(headers or {})
+    if not_modified(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=resp_headers)
+    if encoding != "identity":
+        resp_headers["content-encoding"] = encoding
+    return Response(
+        payload.bodies[encoding], headers=resp_headers, media_type=media_type
+    )
+
+
+def _read(file: Path) -> Tuple[bytes, float, str]:
+    body = file.read_bytes()
+    return body, file.stat().st_mtime, hashlib.sha256(body).hexdigest()[:32]
+
+
+class ProfileCache:
+    """
+    Rendered profiles kept in memory, rebuilt once per update off the event loop.
+    The payloads of the profiles whose content didn't change are kept as they are.
+    """
+
+    def __init__(self) -> None:
+        self.payloads: Dict[str, Payload] = {}
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def reload(self, profiles: Iterable[str]) -> None:
+        async with self._lock:
+            payloads, built = {}, 0
+            for name in profiles:
+                try:
+                    body, mtime, digest = await run_sync(_read, storage.profile(name))
+                except FileNotFoundError:
+                    continue
+                payload = self.payloads.get(name)
+                if payload is None or payload.digest != digest:
+                    payload = await run_sync(Payload, body, mtime, digest)
+                    built += 1
+                payloads[name] = payload
+            self.payloads = payloads
+        logger.debug(f"Loaded {len(payloads)} profile(s) into memory, {built} changed")
+
+    def schedule_reload(self, profiles: Iterable[str]) -> None:
+        """reload in the background, for the commit hook running on the event loop"""
+        self._task = asyncio.get_running_loop().create_task(self.reload(list(profiles)))
+
+    def get(self, name: str) -> Optional[Payload]:
+        return self.payloads.get(name)
+
+
+profile_cache = ProfileCache()
+
+
+class RulesetSchedule:
+    """next time a cron may refresh the rulesets, computed again once it has passed"""
+
+    def __init__(self) -> None:
+        self._triggers: Optional[List[CronTrigger]] = None
+        self._fire: Optional[datetime] = None
+
+    def next_fire(self, now: datetime) -> Optional[datetime]:
+        if self._triggers is None:
+            self._triggers = [
+                CronTrigger.from_crontab(cron, config.update_tz)
+                for cron in (config.update_cron, config.ruleset_cron)
+                if cron
+            ]
+        if self._fire is None or self._fire <= now:
+            fires = [
+                trigger.get_next_fire_time(None, now) for trigger in self._triggers
+            ]
+            self._fire = min((fire for fire in fires if fire), default=None)
+        return self._fire
+
+
+ruleset_schedule = RulesetSchedule()
+
+
+def max_age() -> int:
+    """
+    seconds until the rulesets may be refreshed next, by update_cron or their own
+    schedule. The interval is an upper bound, the scheduler counts it from its start.
+    """
+    now = datetime.now(timezone(config.update_tz))
+    ages = []
+    fire = ruleset_schedule.next_fire(now)
+    if fire:
+        ages.append((fire - now).total_seconds())
+    if config.ruleset_interval:
+        ages.append(config.ruleset_interval)
+    return max(int(min(ages)), 0) if ages else 0
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single `bytes=` range into an inclusive (start, end), return None to
+    serve the whole file, raise ValueError if it can't be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if not start:
+            length = int(end)
+        else:
+            first = int(start)
+            last = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if not start:
+        if length <= 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    if first >= size or last < first:
+        raise ValueError(header)
+    return first, last
+
+
+def _stat_key(file: Path) -> Tuple[Tuple[str, int, int], ...]:
+    """path, mtime and size of the provider file and its variants as they are on disk"""
+    key = []
+    for path in [file] + [
+        file.with_name(file.name + suffix) for suffix in ENCODINGS.values()
+    ]:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        key.append((str(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(key)
+
+
+class ProviderFile:
+    """A provider file on disk and its precompressed variants"""
+
+    def __init__(self, file: Path, key: Tuple[Tuple[str, int, int], ...]) -> None:
+        self.key = key
+        mtimes = {path: mtime for path, mtime, _ in key}
+        sizes = {path: size for path, _, size in key}
+        self.paths = {"identity": file}
+        for encoding, suffix in ENCODINGS.items():
+            variant = file.with_name(file.name + suffix)
+            # a variant older than the file is left from its last version
+            if mtimes.get(str(variant), -1) >= mtimes[str(file)]:
+                self.paths[encoding] = variant
+        sha256 = hashlib.sha256()
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        self.etags = _etags(sha256.hexdigest()[:32], self.paths)
+        self.sizes = {
+            encoding: sizes[str(path)] for encoding, path in self.paths.items()
+        }
+        self.last_modified = formatdate(mtimes[str(file)] / 1e9, usegmt=True)
+
+
+class ProviderCache:
+    """
+    Validators of the provider files, rebuilt off the event loop whenever the file or
+    a variant is replaced on disk, which may happen in the middle of an update
+    """
+
+    def __init__(self) -> None:
+        self.files: Dict[str, ProviderFile] = {}
+
+    async def get(self, name: str) -> Optional[ProviderFile]:
+        file = storage.provider(name)
+        key = _stat_key(file)
+        if not key or key[0][0] != str(file):
+            return None
+        cached = self.files.get(name)
+        if cached is not None and cached.key == key:
+            metrics.cache_hits.inc(cache="provider")
+            return cached
+        metrics.cache_misses.inc(cache="provider")
+        self.files[name] = await run_sync(ProviderFile, file, key)
+        return self.files[name]
+
+
+provider_cache = ProviderCache()
+
+
+def _read_range(file: Path, start: int, end: int) -> bytes:
+    with open(file, "rb") as f:
+        f.seek(start)
+        return f.read(end - start + 1)
+
+
+async def respond_file(request: Request, provider: ProviderFile) -> Response:
+    encoding = negotiate(request.headers.get("accept-encoding", ""), provider.paths)
+    etag, size = provider.etags[encoding], provider.sizes[encoding]
+    headers = {
+        "etag": etag,
+        "last-modified": provider.last_modified,
+        "cache-control": f"public, max-age={max_age()}",
+        "vary": "Accept-Encoding",
+        "accept-ranges": "bytes",
+    }
+    if not_modified(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["content-encoding"] = encoding
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            headers["content-range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        if byte_range:
+            start, end = byte_range
+            body = await run_sync(_read_range, provider.paths[encoding], start, end)
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+            return Response(
+                body, status_code=206, headers=headers, media_type=MEDIA_TYPE
+            )
+    return FileResponse(
+        provider.paths[encoding], headers=headers, media_type=MEDIA_TYPE
+    )
@@ -0,0 +1,183 @@
+import gzip
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Callable, Iterator, List, Optional
+
+from loguru import logger
+
+from config import config
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+DATA_PATH = Path("data")
+GENERATIONS_PATH = DATA_PATH / "generations"
+CURRENT_POINTER = DATA_PATH / "current"
+# rewritten on every commit so the other workers notice new files
+VERSION_STAMP = DATA_PATH / "version"
+CHUNK_SIZE = 64 * 1024
+# suffix of the precompressed variants written next to a provider file
+ENCODINGS = {"gzip": ".gz", "br": ".br"}
+
+
+@contextmanager
+def atomic_open(path: Path) -> Iterator[IO[bytes]]:
+    """write to a temp file next to path and swap it in once done"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def atomic_write(path: Path, data: bytes) -> None:
+    with atomic_open(path) as f:
+        f.write(data)
+
+
+def precompress(file: Path) -> None:
+    """write gzip / brotli variants of file next to it"""
+    with open(file, "rb") as src, atomic_open(file.with_name(file.name + ".gz")) as out:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=out, mtime=0) as gz:
+            shutil.copyfileobj(src, gz, CHUNK_SIZE)
+    if brotli is not None:
+        compressor = brotli.Compressor(quality=9)
+        with open(file, "rb") as src, atomic_open(
+            file.with_name(file.name + ".br")
+        ) as out:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                out.write(compressor.process(chunk))
+            out.write(compressor.finish())
+
+
+class Generation:
+    """A set of profiles and providers that becomes visible all at once"""
+
+    def __init__(self, root: Path, versioned: bool) -> None:
+        self.root = root
+        self.versioned = versioned
+        (root / "profile").mkdir(parents=True, exist_ok=True)
+        (root / "provider").mkdir(parents=True, exist_ok=True)
+
+    def profile(self, name: str) -> Path:
+        return self.root / "profile" / f"{name}.yaml"
+
+    def provider(self, name: str) -> Path:
+        return self.root / "provider" / f"{name}.yaml"
+
+
+class Storage:
+    """
+    Where profiles and providers live. With `generations` set to 0 files are
+    replaced one by one under data/, otherwise every update builds a whole new
+    generation under data/generations/ and switches the `current` pointer to it.
+    """
+
+    def __init__(self, keep: int) -> None:
+        self.keep = keep
+        self.version = 0
+        self._hooks: List[Callable[[], None]] = []
+        self._stamp = self.stamp()
+
+    @property
+    def versioned(self) -> bool:
+        return self.keep > 0
+
+    @staticmethod
+    def stamp() -> Optional[str]:
+        try:
+            return VERSION_STAMP.read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def current(self) -> Optional[str]:
+        try:
+            return CURRENT_POINTER.read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @property
+    def root(self) -> Path:
+        current = self.current() if self.versioned else None
+        return GENERATIONS_PATH / current if current else DATA_PATH
+
+    def profile(self, name: str) -> Path:
+        return self.root / "profile" / f"{name}.yaml"
+
+    def provider(self, name: str) -> Path:
+        return self.root / "provider" / f"{name}.yaml"
+
+    def begin(self) -> Generation:
+        if not self.versioned:
+            return Generation(DATA_PATH, False)
+        base = self.root
+        gen = Generation(
+            GENERATIONS_PATH / datetime.now().strftime("%Y%m%d%H%M%S%f"), True
+        )
+        # start from the last generation so unchanged files carry over
+        for kind in ("profile", "provider"):
+            for src in (base / kind).glob("*.yaml*"):
+                if src.name.startswith("."):
+                    continue
+                dst = gen.root / kind / src.name
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+        return gen
+
+    def on_commit(self, hook: Callable[[], None]) -> None:
+        """call hook every time new files become visible"""
+        self._hooks.append(hook)
+
+    def commit(self, gen: Generation) -> None:
+        if gen.versioned:
+            atomic_write(CURRENT_POINTER, gen.root.name.encode())
+            logger.info(f"Switched to generation {gen.root.name}")
+            self.prune()
+        self._stamp = f"{os.getpid()}-{time.time_ns()}"
+        atomic_write(VERSION_STAMP, self._stamp.encode())
+        self._notify()
+
+    def sync(self) -> bool:
+        """pick up a commit made by another process, return whether there was one"""
+        stamp = self.stamp()
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        self._notify()
+        return True
+
+    def _notify(self) -> None:
+        self.version += 1
+        for hook in self._hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.exception(f"Commit hook {hook} failed: {e}")
+
+    def discard(self, gen: Generation) -> None:
+        if gen.versioned:
+            shutil.rmtree(gen.root, ignore_errors=True)
+
+    def prune(self) -> None:
+        current = self.current()
+        gens = sorted(p for p in GENERATIONS_PATH.iterdir() if p.is_dir())
+        for gen in gens[: -self.keep]:
+            if gen.name != current:
+                shutil.rmtree(gen, ignore_errors=True)
+
+
+storage = Storage(config.generations)
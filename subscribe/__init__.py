@@ -1,58 +1,331 @@
-from typing import Optional, Union, List
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 from loguru import logger
+from pydantic import BaseModel
 
+import metrics
+import serializer
 from clash import SS, SSR, ClashTemplate, Snell, Socks5, Trojan, Vmess
+from clash import templates as template_registry
 from config import config
+from storage import storage
 from subscribe import jms, clash
-from utils import Download
+from subscribe.deps import DependencyGraph, digest_proxies
+from subscribe.parsecache import parse_cache
+from subscribe.probe import prober, probing
+from subscribe.userinfo import CounterCache
+from retry import DownloadError
+from utils import Download, Timer, run_sync
 
 
-async def _subs(
+def _source(name: str) -> str:
+    sub = config.subscribes[name]
+    return sub.file if sub.type == "ClashFile" else sub.url
+
+
+async def _get(
+    name: str, download: Download
+) -> List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]]:
+    sub = config.subscribes[name]
+    logger.debug(f"Fetching subscribe {name}")
+    if sub.type == "jms":
+        return await jms.get(sub.url, download)
+    if sub.type == "ClashSub":
+        return await clash.get_sub(sub.url, download)
+    if sub.type == "ClashFile":
+        return await clash.get_file(sub.file)
+    return []
+
+
+async def _fetch(
+    name: str, download: Download
+) -> List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]]:
+    """the proxies of the subscribe, or the last good ones if it fails or is empty"""
+    try:
+        proxies = await _get(name, download)
+    except Exception as e:
+        last = await parse_cache.last(_source(name))
+        if last is None:
+            raise
+        logger.warning(f"Subscribe {name} failed, use the last good proxies: {e!r}")
+        return last
+    if not proxies:
+        last = await parse_cache.last(_source(name))
+        if last:
+            logger.warning(f"Subscribe {name} has no proxies, use the last good ones")
+            return last
+    return proxies
+
+
+async def _fetch_all(
+    names: List[str], download: Download
+) -> Dict[str, List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]]]:
+    """
+    fetch the subscribes concurrently, the ones failed to download or parse are left
+    out of the result
+    """
+    results = await asyncio.gather(
+        *(_fetch(name, download) for name in names), return_exceptions=True
+    )
+    fetched = {}
+    for name, result in zip(names, results):
+        if isinstance(result, DownloadError):
+            logger.error(f"Subscribe {name} is not available: {result}")
+        elif isinstance(result, Exception):
+            logger.opt(exception=result).error(f"Subscribe {name} failed: {result!r}")
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            fetched[name] = result
+    return fetched
+
+
+# proxies and digest of every subscribe as last fetched, reused by scoped updates
+_last: Dict[str, Tuple[List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]], str]] = {}
+
+
+async def warm() -> None:
+    """load the last good proxies of every subscribe, for the scoped updates"""
+    for name in config.subscribes:
+        if name in _last:
+            continue
+        proxies = await parse_cache.last(_source(name))
+        if proxies:
+            _last[name] = (proxies, await run_sync(digest_proxies, proxies))
+
+
+def _subs(
     subs: List[str],
-    download: Optional[Download],
+    fetched: Dict[str, List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]]],
 ) -> List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]]:
-    download = Download() if download is None else download
     proxies = []
     for name in subs:
-        sub = config.subscribes[name]
-        if sub.type == "jms":
-            proxies += await jms.get(sub.url, download)
-        if sub.type == "ClashSub":
-            proxies += await clash.get_sub(sub.url, download)
-        if sub.type == "ClashFile":
-            proxies += await clash.get_file(sub.file)
+        proxies += fetched[name]
     return proxies
 
 
-async def update():
-    logger.info("Start update profiles")
+def _sources(
+    subs: List[str],
+    fetched: Dict[str, List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]]],
+    proxies: List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]],
+) -> List[str]:
+    """the subscribe of every proxy, which may have been reordered since fetched"""
+    source = {id(proxy): name for name in subs for proxy in fetched[name]}
+    return [source[id(proxy)] for proxy in proxies]
+
+
+class UpdateStatus(BaseModel):
+    fresh: bool = False
+    running: bool = False
+    last_success: Optional[datetime] = None
+    last_error: Optional[str] = None
+
+
+status = UpdateStatus()
+
+
+class UpdateResult(BaseModel):
+    rebuilt: List[str] = []
+    skipped: List[str] = []
+    kept: List[str] = []
+    error: Optional[str] = None
+    timings: Dict[str, float] = {}
+
+
+def _render(
+    profile: str,
+    file: Path,
+    template: ClashTemplate,
+    proxies: List[Union[SS, SSR, Vmess, Socks5, Snell, Trojan]],
+    sources: List[str],
+) -> None:
+    logger.debug(
+        f"Generating profile {profile} from template {config.profiles[profile].template}"
+    )
+    clash = template.render(proxies, config.profiles[profile].top_proxies, sources)
+    if clash.rule_providers:
+        for provider in clash.rule_providers:
+            clash.rule_providers[provider].url = "/".join(
+                [config.domian, config.urlprefix, "provider", f"{provider}.yaml"]
+            )
+    clash.save(file)
+
+
+def _settings(name: str) -> Dict:
+    """the part of the config a rendered profile depends on"""
+    return {
+        "profile": config.profiles[name].dict(exclude={"cron", "interval"}),
+        "domian": config.domian,
+        "urlprefix": config.urlprefix,
+        "yaml_engine": serializer.engine(),
+    }
+
+
+async def update(
+    force: bool = False,
+    profiles: Optional[Iterable[str]] = None,
+    timer: Optional[Timer] = None,
+    rulesets: bool = True,
+    subs: Optional[Iterable[str]] = None,
+) -> UpdateResult:
+    """
+    Update the rulesets and every profile whose inputs changed since it was last
+    rendered, or all of them if force. With `profiles` only those profiles are
+    rendered, the others are carried over as they are. With `subs` only those
+    subscribes are fetched again, the others are taken from the last fetch if there
+    is one. The rulesets are left as they are unless `rulesets`.
+    """
+    selected = {
+        name: config.profiles[name]
+        for name in (config.profiles if profiles is None else profiles)
+    }
+    logger.info(f"Start update profiles {list(selected)}")
     download = Download()
+    timer = Timer() if timer is None else timer
+    gen = storage.begin()
+    graph = DependencyGraph()
+    result = UpdateResult()
+    status.running = True
+
+    async def providers(urls: Dict[str, str]):
+        with timer.stage("ruleset"):
+            await download.provider(urls, gen)
+
+    ruleset_task = None
     try:
-        rulesets = {}
-        for profile in config.profiles:
-            proxies = await _subs(config.profiles[profile].subs, download)
-            logger.debug(
-                f"Generating profile {profile} from template {config.profiles[profile].template}"
+        with timer.stage("template"):
+            # cached templates are shared with the other threads, not with processes
+            loop = asyncio.get_running_loop()
+            names = list(
+                dict.fromkeys(
+                    p.template
+                    for p in (config.profiles if rulesets else selected).values()
+                )
             )
-            template = ClashTemplate.load(config.profiles[profile].template)
-            clash = template.render(proxies)
-            if clash.rule_providers:
-                for provider in clash.rule_providers:
-                    rulesets[provider] = clash.rule_providers[provider].url
-                    clash.rule_providers[provider].url = "/".join(
-                        [config.domian, config.urlprefix, "provider", f"{provider}.yaml"]
+            loaded = await asyncio.gather(
+                *(
+                    loop.run_in_executor(None, template_registry.load, name)
+                    for name in names
+                )
+            )
+            templates = {name: template for name, (template, _) in zip(names, loaded)}
+            # hashed with the very content loaded, the file may change during the update
+            template_digests = {
+                name: digest for name, (_, digest) in zip(names, loaded)
+            }
+
+        # rulesets are known from the templates, start downloading them right now
+        urls = {}
+        for profile in config.profiles.values() if rulesets else []:
+            rule_providers = templates[profile.template].rule_providers or {}
+            for provider in rule_providers:
+                urls[provider] = rule_providers[provider].url
+        ruleset_task = asyncio.create_task(providers(urls)) if urls else None
+
+        needed = list(dict.fromkeys(sub for p in selected.values() for sub in p.subs))
+        wanted = [s for s in needed if subs is None or s in subs or s not in _last]
+        with timer.stage("subscribe"):
+            fetched = await _fetch_all(wanted, download)
+        with timer.stage("render"):
+            digests = await asyncio.gather(
+                *(run_sync(digest_proxies, fetched[sub]) for sub in fetched)
+            )
+            for sub, digest in zip(fetched, digests):
+                _last[sub] = (fetched[sub], digest)
+            available = {
+                sub: _last[sub][0]
+                for sub in needed
+                if sub in fetched or sub not in wanted
+            }
+            probed = [
+                name
+                for name, profile in selected.items()
+                if probing(profile) and all(sub in available for sub in profile.subs)
+            ]
+            if probed:
+                with timer.stage("probe"):
+                    probed_subs = dict.fromkeys(
+                        sub for name in probed for sub in config.profiles[name].subs
+                    )
+                    await prober.probe(_subs(list(probed_subs), available))
+            renders, keys = [], {}
+            for name, profile in selected.items():
+                missing = [sub for sub in profile.subs if sub not in available]
+                if missing:
+                    logger.warning(
+                        f"Keep the last profile {name}, {missing} not available"
+                    )
+                    result.kept.append(name)
+                    continue
+                proxies = _subs(profile.subs, available)
+                settings = _settings(name)
+                if name in probed:
+                    proxies = prober.arrange(proxies, profile)
+                    settings["arranged"] = [proxy.name for proxy in proxies]
+                keys[name] = graph.key(
+                    template_digests[profile.template],
+                    {sub: _last[sub][1] for sub in profile.subs},
+                    settings,
+                )
+                metrics.profile_proxies.set(len(proxies), profile=name)
+                if (
+                    not force
+                    and gen.profile(name).exists()
+                    and not graph.changed(name, keys[name])
+                ):
+                    result.skipped.append(name)
+                    continue
+                result.rebuilt.append(name)
+                renders.append(
+                    run_sync(
+                        _render,
+                        name,
+                        gen.profile(name),
+                        templates[profile.template],
+                        proxies,
+                        _sources(profile.subs, available, proxies),
                     )
-            clash.save(profile)
-        await download.provider(rulesets)
-        logger.success("Update complete")
+                )
+            await asyncio.gather(*renders)
+        if ruleset_task is not None:
+            await ruleset_task
+        storage.commit(gen)
+        for name in result.rebuilt:
+            graph.record(name, keys[name])
+        graph.save()
+        status.fresh, status.last_success, status.last_error = (
+            True,
+            datetime.now(),
+            None,
+        )
+        logger.success(
+            f"Update complete, rebuilt {result.rebuilt}, "
+            f"skipped {result.skipped}: {timer}"
+        )
+        counter_cache.warm(selected)
 
     except Exception as e:
+        if ruleset_task is not None:
+            # don't leave it writing into the generation being discarded
+            ruleset_task.cancel()
+            await asyncio.gather(ruleset_task, return_exceptions=True)
+        storage.discard(gen)
+        status.last_error = result.error = str(e)
         logger.critical(e)
-        return e
 
+    finally:
+        status.running = False
+        result.timings = timer.dict()
+        for stage, cost in result.timings.items():
+            metrics.update_stage_seconds.observe(cost, stage=stage)
+        metrics.updates.inc(result="error" if result.error else "success")
+    return result
 
-async def counter(profile: str):
+
+async def _counter(profile: str):
     if len(config.profiles[profile].subs) != 1:
         logger.warning("Subscribe(s) is not 1, counter function disabled")
         return ""
@@ -62,3 +335,10 @@ async def counter(profile: str):
     elif sub.type == "ClashSub":
         return await clash.counter(sub.url)
     return ""
+
+
+counter_cache = CounterCache(_counter, config.counter_ttl, config.counter_fallback)
+
+
+async def counter(profile: str) -> str:
+    return await counter_cache.get(profile)
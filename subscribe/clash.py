@@ -2,15 +2,17 @@ from pathlib import Path
 from httpx import Response
 from typing import Optional, Union, List
 
-import yaml
+import serializer
 
-from clash import SS, SSR, Snell, Socks5, Trojan, Vmess, Clash
-from utils import Download
+from clash import SS, SSR, Snell, Socks5, Trojan, Vmess
+from subscribe import parser
+from subscribe.parsecache import parse_cache
+from utils import Download, run_sync
 
 
 async def counter(url, download: Optional[Download] = None):
     download = Download() if download is None else download
-    resp: Response = await download.client.get(url)
+    resp: Response = await download.request(url, kind="counter")
     try:
         return resp.headers.get("subscription-userinfo")
     except KeyError:
@@ -21,12 +23,20 @@ async def get_sub(
     url: str, download: Optional[Download]
 ) -> List[Union[SS, SSR, Snell, Socks5, Trojan, Vmess]]:
     download = Download() if download is None else download
-    return Clash.parse_obj(
-        yaml.load(await download.content(url), Loader=yaml.FullLoader)
-    ).proxies
+    return await parse_cache.parse(url, await download.subscription(url), parse)
 
 
 async def get_file(file: str) -> List[Union[SS, SSR, Snell, Socks5, Trojan, Vmess]]:
-    return Clash.parse_obj(
-        yaml.load(Path(file).read_bytes(), Loader=yaml.FullLoader)
-    ).proxies
+    return await parse_cache.parse(file, await run_sync(Path(file).read_bytes), parse)
+
+
+def parse(content: bytes) -> List[Union[SS, SSR, Snell, Socks5, Trojan, Vmess]]:
+    data = serializer.load(content)
+    if not isinstance(data, dict):
+        raise ValueError(
+            f"Not a Clash profile, got {type(data).__name__} instead of a mapping"
+        )
+    # only the proxies are used, don't validate the rest of the profile
+    report = parser.parse_items(data.get("proxies") or [])
+    report.log()
+    return report.proxies
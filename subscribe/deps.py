@@ -0,0 +1,60 @@
+import hashlib
+import json
+from typing import Dict, List
+
+from pydantic import BaseModel
+
+from storage import atomic_write
+from utils import CACHE_PATH
+
+# bump when the rendered output changes for the same inputs
+DEPS_VERSION = 1
+
+
+def digest_proxies(proxies: List[BaseModel]) -> str:
+    """content hash of a parsed proxy list"""
+    sha256 = hashlib.sha256()
+    for proxy in proxies:
+        sha256.update(
+            json.dumps(
+                proxy.dict(exclude_none=True, by_alias=True),
+                sort_keys=True,
+                default=str,
+            ).encode()
+        )
+        sha256.update(b"\n")
+    return sha256.hexdigest()
+
+
+class DependencyGraph:
+    """The hash of every input a profile was last rendered from"""
+
+    def __init__(self, file=CACHE_PATH / "deps.json") -> None:
+        self.file = file
+        try:
+            self.data: Dict[str, str] = json.loads(file.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            self.data = {}
+
+    @staticmethod
+    def key(template: str, subs: Dict[str, str], settings: Dict) -> str:
+        return hashlib.sha256(
+            json.dumps(
+                {
+                    "version": DEPS_VERSION,
+                    "template": template,
+                    "subs": subs,
+                    "settings": settings,
+                },
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+
+    def changed(self, profile: str, key: str) -> bool:
+        return self.data.get(profile) != key
+
+    def record(self, profile: str, key: str) -> None:
+        self.data[profile] = key
+
+    def save(self) -> None:
+        atomic_write(self.file, json.dumps(self.data, indent=2).encode())
@@ -1,17 +1,19 @@
 import base64
 import json
 from datetime import datetime
-from typing import Optional, Union, List
+from typing import Dict, Optional, Union, List
 
 from pytz import timezone
 
 from clash import SS, Vmess
+from subscribe import parser
+from subscribe.parsecache import parse_cache
 from utils import Download
 
 
 async def counter(url, tz: Optional[str] = None, download: Optional[Download] = None):
     download = Download() if download is None else download
-    info = json.loads(await download.content(url))
+    info = json.loads(await download.content(url, kind="counter"))
     download_ = info["bw_counter_b"]
     total = info["monthly_bw_limit_b"]
     timenow = datetime.now()
@@ -33,8 +35,10 @@ async def counter(url, tz: Optional[str] = None, download: Optional[Download] =
     return f"upload=0; download={download_}; total={total}; expire={expire}"
 
 
-def ss(sub: str) -> "SS":
+def ss(sub: str) -> Dict:
     """Format the ShadowSocks proxy like ss://{base64encode}#{name}@{server}:{port}"""
+    if "@" not in sub.partition("#")[2]:
+        return parser.ss(sub)
     ci_pa, se_po = sub[5:].split("#")
 
     ci_pa = base64.b64decode(f"{ci_pa}===").decode().split("@")[0]
@@ -43,50 +47,50 @@ def ss(sub: str) -> "SS":
     se, po = se_po.split("@")[1].split(":")
     na = "JMS-" + se.split(".")[0]
 
-    return SS(
-        **{
-            "name": na,
-            "server": se,
-            "type": "ss",
-            "port": int(po),
-            "cipher": ci,
-            "password": pa,
-            "udp": True,
-        }
-    )
+    return {
+        "name": na,
+        "server": se,
+        "type": "ss",
+        "port": int(po),
+        "cipher": ci,
+        "password": pa,
+        "udp": True,
+    }
 
 
-def vmess(sub: str) -> "Vmess":
+def vmess(sub: str) -> Dict:
     """Format the Vmess proxy like vmess://{base64encode}"""
     vmess = json.loads(base64.b64decode(f"{sub[8:]}===").decode())
+    if "@" not in str(vmess.get("ps", "")):
+        return parser.vmess(sub)
 
     se = str(vmess["ps"]).split("@")[1].split(":")[0]
     na = "JMS-" + se.split(".")[0]
 
-    return Vmess(
-        **{
-            "name": na,
-            "server": se,
-            "port": int(vmess["port"]),
-            "type": "vmess",
-            "uuid": vmess["id"],
-            "alterId": vmess["aid"],
-            "cipher": "auto",
-            "tls": vmess["tls"] != "none",
-            "skip-cert-verify": True,
-            "udp": True,
-        }
-    )
+    return {
+        "name": na,
+        "server": se,
+        "port": int(vmess["port"]),
+        "type": "vmess",
+        "uuid": vmess["id"],
+        "alterId": vmess["aid"],
+        "cipher": "auto",
+        "tls": vmess["tls"] != "none",
+        "skip-cert-verify": True,
+        "udp": True,
+    }
+
+
+# JMS names its nodes after the server, other links are parsed as usual
+schemes = parser.schemes.extend({"ss": ss, "vmess": vmess})
 
 
 async def get(url: str, download: Optional[Download]) -> List[Union[SS, Vmess]]:
     download = Download() if download is None else download
-    bsubs = await download.content(url)
-    subs = base64.decodebytes(bsubs).decode().split("\n")
-    proxies = []
-    for sub in subs:
-        if sub.startswith("ss://"):
-            proxies.append(ss(sub))
-        elif sub.startswith("vmess://"):
-            proxies.append(vmess(sub))
-    return proxies
+    return await parse_cache.parse(url, await download.subscription(url), parse)
+
+
+def parse(bsubs: bytes) -> List[Union[SS, Vmess]]:
+    report = schemes.parse(base64.decodebytes(bsubs).decode().split("\n"))
+    report.log()
+    return report.proxies
@@ -0,0 +1,164 @@
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Literal, Optional
+from uuid import uuid4
+
+from loguru import logger
+from pydantic import BaseModel
+
+from config import config
+from storage import atomic_write
+from subscribe import UpdateResult, update
+from utils import CACHE_PATH, Timer
+
+JOBS_PATH = CACHE_PATH / "jobs"
+# finished jobs kept for the status endpoint
+KEEP_JOBS = 50
+
+
+class Job(BaseModel):
+    id: str
+    state: Literal["queued", "running", "done", "failed"] = "queued"
+    force: bool = False
+    # None means every profile
+    profiles: Optional[List[str]] = None
+    # subscribes to fetch again, None means every one the profiles use
+    subs: Optional[List[str]] = None
+    rulesets: bool = True
+    # ids of the triggers merged into this job
+    triggers: List[str] = []
+    created: datetime
+    started: Optional[datetime] = None
+    finished: Optional[datetime] = None
+    stages: Dict[str, Dict] = {}
+    result: Optional[UpdateResult] = None
+
+    def merge(self, **scope) -> None:
+        self.force = self.force or scope["force"]
+        self.rulesets = self.rulesets or scope["rulesets"]
+        self.profiles = _union(self.profiles, scope["profiles"])
+        self.subs = _union(self.subs, scope["subs"])
+
+
+def _union(a: Optional[List[str]], b: Optional[List[str]]) -> Optional[List[str]]:
+    return None if a is None or b is None else list(dict.fromkeys(a + b))
+
+
+def scope(
+    profiles: Optional[Iterable[str]] = None, subs: Optional[Iterable[str]] = None
+) -> Optional[List[str]]:
+    """profiles to update for the given profiles and subscribes, None for all of them"""
+    if not profiles and not subs:
+        return None
+    names = list(profiles or [])
+    for sub in subs or []:
+        names += [name for name, p in config.profiles.items() if sub in p.subs]
+    return list(dict.fromkeys(names))
+
+
+class JobManager:
+    """
+    Runs one update at a time. Triggers arriving while a job is running are merged
+    into the one queued job, never into the running one, which may have read its
+    inputs already.
+    """
+
+    def __init__(self, path: Path = JOBS_PATH) -> None:
+        self.path = path
+        self.jobs: Dict[str, Job] = {}
+        self._queued: Optional[Job] = None
+        self._running: Optional[Job] = None
+        self._timer: Optional[Timer] = None
+        self._worker: Optional["asyncio.Task[None]"] = None
+        self._done: Dict[str, asyncio.Event] = {}
+        self._hooks: List[Callable[[Job], None]] = []
+
+    def on_finish(self, hook: Callable[[Job], None]) -> None:
+        self._hooks.append(hook)
+
+    def submit(
+        self,
+        force: bool = False,
+        profiles: Optional[List[str]] = None,
+        subs: Optional[List[str]] = None,
+        rulesets: bool = True,
+        trigger: Optional[str] = None,
+    ) -> Job:
+        scope = dict(force=force, profiles=profiles, subs=subs, rulesets=rulesets)
+        job = self._queued
+        if job is not None:
+            job.merge(**scope)
+        else:
+            job = self._queued = Job(id=uuid4().hex, created=datetime.now(), **scope)
+            self.jobs[job.id] = job
+            self._done[job.id] = asyncio.Event()
+        if trigger:
+            job.triggers.append(trigger)
+        self.save(job)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._work())
+        return job
+
+    async def wait(self, id: str) -> Job:
+        await self._done[id].wait()
+        return self.jobs[id]
+
+    def get(self, id: str) -> Optional[Job]:
+        job = self.jobs.get(id)
+        if job is not None:
+            if job is self._running and self._timer is not None:
+                job.stages = self._timer.progress()
+            return job
+        # the job may be run by another worker
+        try:
+            return Job.parse_file(self.path / f"{id}.json")
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def checkpoint(self) -> None:
+        """share the progress of the running job with the other workers"""
+        if self._running is not None:
+            self.save(self.get(self._running.id))
+
+    def save(self, job: Job) -> None:
+        data = job.json().encode()
+        for id in [job.id] + job.triggers:
+            atomic_write(self.path / f"{id}.json", data)
+
+    async def _work(self) -> None:
+        while self._queued is not None:
+            job, self._queued = self._queued, None
+            self._running, self._timer = job, Timer()
+            job.state, job.started = "running", datetime.now()
+            self.save(job)
+            logger.info(f"Running update job {job.id}")
+            try:
+                job.result = await update(
+                    job.force, job.profiles, self._timer, job.rulesets, job.subs
+                )
+                job.state = "failed" if job.result.error else "done"
+            except Exception as e:
+                logger.exception(f"Update job {job.id} failed: {e}")
+                job.result, job.state = UpdateResult(error=str(e)), "failed"
+            job.finished, job.stages = datetime.now(), self._timer.progress()
+            self._running = self._timer = None
+            self.save(job)
+            self._done[job.id].set()
+            for hook in self._hooks:
+                try:
+                    hook(job)
+                except Exception as e:
+                    logger.exception(f"Job hook {hook} failed: {e}")
+            self._prune()
+
+    def _prune(self) -> None:
+        finished = [job for job in self.jobs.values() if job.finished]
+        for job in finished[:-KEEP_JOBS]:
+            del self.jobs[job.id]
+            del self._done[job.id]
+            for id in [job.id] + job.triggers:
+                (self.path / f"{id}.json").unlink(missing_ok=True)
+
+
+jobs = JobManager()
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+
+from clash.proxy import PROXY_MODELS
+from config import config
+from storage import atomic_write
+from utils import CACHE_PATH, run_sync
+
+
+class ParseCache:
+    """
+    Validated proxies of every subscription content seen, keyed by the hash of the
+    raw content, so identical content is never parsed twice, not even across
+    restarts. The least recently used entries are evicted over `max_size` bytes,
+    except the last good one of each source.
+    """
+
+    def __init__(self, path: Path = CACHE_PATH / "parsed", max_size: int = 0) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.index_file = path / "index.json"
+        try:
+            # source (url or file) -> key of its last non-empty result
+            self.index: Dict[str, str] = json.loads(self.index_file.read_text("utf-8"))
+        except (FileNotFoundError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def key(content: bytes, parser: Callable) -> str:
+        sha256 = hashlib.sha256(f"{parser.__module__}.{parser.__qualname__}\n".encode())
+        sha256.update(content)
+        return sha256.hexdigest()
+
+    def _file(self, key: str) -> Path:
+        return self.path / f"{key}.json"
+
+    def load(self, key: str) -> Optional[List[BaseModel]]:
+        file = self._file(key)
+        try:
+            data = json.loads(file.read_bytes())
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(file)
+        # validated before they were stored
+        return [PROXY_MODELS[proxy["type"]].construct(**proxy) for proxy in data]
+
+    def store(self, key: str, proxies: List[BaseModel]) -> None:
+        atomic_write(
+            self._file(key),
+            json.dumps(
+                [proxy.dict(exclude_none=True) for proxy in proxies],
+                ensure_ascii=False,
+                separators=(",", ":"),
+            ).encode(),
+        )
+        self.evict()
+
+    def evict(self) -> None:
+        if not self.max_size:
+            return
+        keep = set(self.index.values())
+        files = sorted(
+            (file.stat().st_mtime, file.stat().st_size, file)
+            for file in self.path.glob("*.json")
+            if file != self.index_file
+        )
+        total = sum(size for _, size, _ in files)
+        for _, size, file in files:
+            if total <= self.max_size:
+                break
+            if file.stem in keep:
+                continue
+            file.unlink(missing_ok=True)
+            total -= size
+
+    async def parse(
+        self, source: str, content: bytes, parser: Callable[[bytes], List[BaseModel]]
+    ) -> List[BaseModel]:
+        key = self.key(content, parser)
+        proxies = await run_sync(self.load, key)
+        if proxies is None:
+            proxies = await run_sync(parser, content)
+            await run_sync(self.store, key, proxies)
+        else:
+            logger.debug(f"{source} is parsed already")
+        if proxies and self.index.get(source) != key:
+            self.index[source] = key
+            atomic_write(self.index_file, json.dumps(self.index, indent=2).encode())
+        return proxies
+
+    async def last(self, source: str) -> Optional[List[BaseModel]]:
+        """the last non-empty result of the source"""
+        key = self.index.get(source)
+        return None if key is None else await run_sync(self.load, key)
+
+
+parse_cache = ParseCache(max_size=config.parse_cache_size)
@@ -0,0 +1,280 @@
+"""
+Share links (ss://, ssr://, vmess://, trojan://) and proxy dicts to validated
+proxies. Entries are validated in batches, a bad one is quarantined with a
+diagnostic instead of failing the whole subscription.
+"""
+import base64
+import json
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote
+
+from loguru import logger
+from pydantic import BaseModel, ValidationError, parse_obj_as
+
+import metrics
+from clash.proxy import Proxy
+
+BATCH_SIZE = 256
+
+
+class Diagnostic(BaseModel):
+    # line of the subscription or position in the proxies list, from 1
+    index: int
+    scheme: str
+    name: Optional[str] = None
+    error: str
+
+
+class Report:
+    def __init__(self) -> None:
+        self.proxies: List[BaseModel] = []
+        self.quarantined: List[Diagnostic] = []
+
+    def quarantine(
+        self, index: int, scheme: str, error: str, name: Optional[str] = None
+    ) -> None:
+        self.quarantined.append(
+            Diagnostic(index=index, scheme=scheme, name=name, error=error)
+        )
+        metrics.quarantined.inc(scheme=scheme)
+
+    def log(self) -> None:
+        for d in sorted(self.quarantined, key=lambda d: d.index):
+            name = f" {d.name}" if d.name else ""
+            logger.warning(f"Skip entry {d.index} ({d.scheme}{name}): {d.error}")
+        if self.quarantined:
+            logger.warning(
+                f"{len(self.proxies)} proxies parsed, {len(self.quarantined)} skipped"
+            )
+
+
+# (index, scheme, name, proxy dict)
+Item = Tuple[int, str, Optional[str], Dict]
+
+
+def validate(items: List[Item], report: Report) -> None:
+    """validate the whole batch at once, only retry without the bad items on error"""
+    if not items:
+        return
+    try:
+        report.proxies += parse_obj_as(List[Proxy], [item[3] for item in items])
+        return
+    except ValidationError as e:
+        errors: Dict[int, List[str]] = {}
+        for error in e.errors():
+            # ('__root__', position, ...)
+            errors.setdefault(error["loc"][1], []).append(
+                f"{'.'.join(str(loc) for loc in error['loc'][2:])}: {error['msg']}"
+            )
+    for i, (index, scheme, name, _) in enumerate(items):
+        if i in errors:
+            report.quarantine(index, scheme, "; ".join(errors[i]), name)
+    validate([item for i, item in enumerate(items) if i not in errors], report)
+
+
+def parse_items(items: Iterable, report: Optional[Report] = None) -> Report:
+    """validate proxy dicts, like the proxies of a Clash profile"""
+    report = Report() if report is None else report
+    batch: List[Item] = []
+    for index, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            report.quarantine(index, "", "not a mapping")
+            continue
+        batch.append((index, str(item.get("type", "")), item.get("name"), item))
+        if len(batch) >= BATCH_SIZE:
+            validate(batch, report)
+            batch = []
+    validate(batch, report)
+    return report
+
+
+class Registry:
+    """Parsers of the share links by scheme"""
+
+    def __init__(self, parsers: Optional[Dict[str, Callable[[str], Dict]]] = None):
+        self.parsers = dict(parsers or {})
+
+    def register(self, scheme: str):
+        def decorator(func: Callable[[str], Dict]) -> Callable[[str], Dict]:
+            self.parsers[scheme] = func
+            return func
+
+        return decorator
+
+    def extend(self, parsers: Dict[str, Callable[[str], Dict]]) -> "Registry":
+        """a copy with some of the schemes handled differently"""
+        return Registry(dict(self.parsers, **parsers))
+
+    def parse(self, lines: Iterable[str]) -> Report:
+        report = Report()
+        batch: List[Item] = []
+        for index, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            scheme = line.partition("://")[0].lower() if "://" in line else ""
+            name = unquote(line.partition("#")[2]) or None
+            parser = self.parsers.get(scheme)
+            if parser is None:
+                report.quarantine(index, scheme, "unsupported scheme", name)
+                continue
+            try:
+                proxy = parser(line)
+            except Exception as e:
+                report.quarantine(index, scheme, repr(e), name)
+                continue
+            batch.append((index, scheme, proxy.get("name"), proxy))
+            if len(batch) >= BATCH_SIZE:
+                validate(batch, report)
+                batch = []
+        validate(batch, report)
+        return report
+
+
+def b64decode(data: str) -> str:
+    """standard or url-safe base64, with or without padding"""
+    data = data.strip().replace("-", "+").replace("_", "/")
+    return base64.b64decode(data + "=" * (-len(data) % 4)).decode()
+
+
+def split(uri: str) -> Tuple[str, Dict[str, str], str]:
+    """body, query and fragment of a share link"""
+    body = uri.partition("://")[2]
+    body, _, fragment = body.partition("#")
+    body, _, query = body.partition("?")
+    params = {key: values[0] for key, values in parse_qs(query).items()}
+    return body.rstrip("/"), params, unquote(fragment)
+
+
+def host_port(value: str) -> Tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+schemes = Registry()
+
+
+@schemes.register("ss")
+def ss(uri: str) -> Dict:
+    """SIP002 ss://userinfo@host:port/?plugin=...#name or legacy ss://base64#name"""
+    body, params, name = split(uri)
+    if "@" in body:
+        userinfo, _, address = body.rpartition("@")
+        userinfo = unquote(userinfo)
+        if ":" not in userinfo:
+            userinfo = b64decode(userinfo)
+    else:
+        userinfo, _, address = b64decode(body).rpartition("@")
+    cipher, _, password = userinfo.partition(":")
+    server, port = host_port(address)
+    proxy = {
+        "name": name or f"{server}:{port}",
+        "type": "ss",
+        "server": server,
+        "port": port,
+        "cipher": cipher,
+        "password": password,
+        "udp": True,
+    }
+    if params.get("plugin"):
+        plugin, *options = params["plugin"].split(";")
+        opts = dict(option.partition("=")[::2] for option in options)
+        if plugin in ("obfs-local", "simple-obfs"):
+            proxy["plugin"] = "obfs"
+            proxy["plugin-opts"] = {
+                "mode": opts.get("obfs"),
+                "host": opts.get("obfs-host"),
+            }
+        else:
+            proxy["plugin"] = plugin
+            proxy["plugin-opts"] = {
+                "mode": opts.get("mode", "websocket"),
+                "host": opts.get("host"),
+                "path": opts.get("path"),
+                "tls": "tls" in opts,
+            }
+    return proxy
+
+
+@schemes.register("ssr")
+def ssr(uri: str) -> Dict:
+    """ssr://base64(host:port:protocol:method:obfs:base64(password)/?params)"""
+    body, _, query = b64decode(uri.partition("://")[2]).partition("/?")
+    host, port, protocol, method, obfs, password = body.rsplit(":", 5)
+    params = {key: b64decode(values[0]) for key, values in parse_qs(query).items()}
+    return {
+        "name": params.get("remarks") or f"{host}:{port}",
+        "type": "ssr",
+        "server": host.strip("[]"),
+        "port": int(port),
+        "cipher": method,
+        "password": b64decode(password),
+        "protocol": protocol,
+        "obfs": obfs,
+        "protocol-param": params.get("protoparam"),
+        "obfs-param": params.get("obfsparam"),
+        "udp": True,
+    }
+
+
+@schemes.register("vmess")
+def vmess(uri: str) -> Dict:
+    """vmess://base64(json) as shared by v2rayN"""
+    data = json.loads(b64decode(uri.partition("://")[2]))
+    proxy = {
+        "name": data.get("ps") or f"{data['add']}:{data['port']}",
+        "type": "vmess",
+        "server": data["add"],
+        "port": int(data["port"]),
+        "uuid": data["id"],
+        "alterId": int(data.get("aid") or 0),
+        "cipher": data.get("scy") or "auto",
+        "udp": True,
+    }
+    if data.get("tls") == "tls":
+        proxy["tls"] = True
+        if data.get("sni"):
+            proxy["servername"] = data["sni"]
+    network = data.get("net") or "tcp"
+    if network == "ws":
+        proxy["network"] = "ws"
+        proxy["ws-opts"] = {"path": data.get("path") or "/"}
+        if data.get("host"):
+            proxy["ws-opts"]["headers"] = {"Host": data["host"]}
+    elif network == "grpc":
+        proxy["network"] = "grpc"
+        proxy["grpc-opts"] = {"grpc-service-name": data.get("path", "")}
+    elif network == "h2":
+        proxy["network"] = "h2"
+        proxy["h2-opts"] = {"host": [data.get("host")], "path": data.get("path") or "/"}
+    return proxy
+
+
+@schemes.register("trojan")
+def trojan(uri: str) -> Dict:
+    """trojan://password@host:port?sni=...&type=ws&path=...#name"""
+    body, params, name = split(uri)
+    password, _, address = body.rpartition("@")
+    server, port = host_port(address)
+    proxy = {
+        "name": name or f"{server}:{port}",
+        "type": "trojan",
+        "server": server,
+        "port": port,
+        "password": unquote(password),
+        "udp": True,
+    }
+    sni = params.get("sni") or params.get("peer")
+    if sni:
+        proxy["sni"] = sni
+    if params.get("allowInsecure") in ("1", "true"):
+        proxy["skip-cert-verify"] = True
+    if params.get("type") == "ws":
+        proxy["network"] = "ws"
+        proxy["ws-opts"] = {"path": params.get("path") or "/"}
+        if params.get("host"):
+            proxy["ws-opts"]["headers"] = {"Host": params["host"]}
+    elif params.get("type") == "grpc":
+        proxy["network"] = "grpc"
+        proxy["grpc-opts"] = {"grpc-service-name": params.get("serviceName", "")}
+    return proxy
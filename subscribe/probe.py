@@ -0,0 +1,143 @@
+import asyncio
+import ssl
+import time
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+import metrics
+from config import Profile, config
+
+# server, port, sni or None for a plain TCP connect
+Target = Tuple[str, int, Optional[str]]
+
+
+def _context() -> ssl.SSLContext:
+    # only the reachability is measured, the certificates are not checked
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class Prober:
+    """
+    TCP connect (and TLS handshake) latency of the proxies, with at most
+    `concurrency` checks in flight. Results are cached for `ttl` seconds, so the
+    servers shared by several subscribes or updates are only checked once.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 64,
+        timeout: float = 3,
+        tls: bool = False,
+        ttl: float = 600,
+    ) -> None:
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.tls = tls
+        self.ttl = ttl
+        # target -> (checked at, latency in seconds or None if unreachable)
+        self._cache: Dict[Target, Tuple[float, Optional[float]]] = {}
+        self._context: Optional[ssl.SSLContext] = None
+
+    def target(self, proxy: BaseModel) -> Target:
+        extra = proxy.__dict__
+        sni = None
+        if self.tls and (proxy.type == "trojan" or extra.get("tls")):
+            sni = extra.get("sni") or extra.get("servername") or proxy.server
+        return proxy.server, proxy.port, sni
+
+    async def check(
+        self, server: str, port: int, sni: Optional[str] = None
+    ) -> Optional[float]:
+        """seconds to connect to the server, None if it is not reachable in time"""
+        if sni and self._context is None:
+            self._context = _context()
+        start = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    server,
+                    port,
+                    ssl=self._context if sni else None,
+                    server_hostname=sni,
+                ),
+                self.timeout,
+            )
+        except (OSError, asyncio.TimeoutError, ssl.SSLError) as e:
+            logger.trace(f"Probe {server}:{port} failed: {e!r}")
+            metrics.probes.inc(result="unreachable")
+            return None
+        latency = time.perf_counter() - start
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+        metrics.probes.inc(result="reachable")
+        return latency
+
+    async def probe(self, proxies: List[BaseModel]) -> None:
+        """check the proxies without a fresh result"""
+        now = time.monotonic()
+        self._cache = {
+            target: result
+            for target, result in self._cache.items()
+            if now - result[0] < self.ttl
+        }
+        targets = list(
+            dict.fromkeys(
+                target
+                for target in map(self.target, proxies)
+                if target not in self._cache
+            )
+        )
+        if not targets:
+            return
+        logger.debug(f"Probing {len(targets)} servers")
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def check(target: Target) -> None:
+            async with sem:
+                latency = await self.check(*target)
+            self._cache[target] = (time.monotonic(), latency)
+
+        await asyncio.gather(*(check(target) for target in targets))
+
+    def latency(self, proxy: BaseModel) -> Optional[float]:
+        result = self._cache.get(self.target(proxy))
+        return None if result is None else result[1]
+
+    def arrange(self, proxies: List[BaseModel], profile: Profile) -> List[BaseModel]:
+        """
+        drop the unreachable proxies and / or sort them by latency as the profile
+        asks, the unreachable ones go last. Nothing is dropped if none is reachable,
+        the probe itself is more likely broken than every server.
+        """
+        latencies = [self.latency(proxy) for proxy in proxies]
+        reachable = [p for p, latency in zip(proxies, latencies) if latency is not None]
+        if profile.drop_unreachable:
+            if reachable:
+                proxies, latencies = reachable, [l for l in latencies if l is not None]
+            else:
+                logger.warning("No proxy is reachable, keep all of them")
+        if profile.sort_by_latency:
+            order = sorted(
+                range(len(proxies)),
+                key=lambda i: (latencies[i] is None, latencies[i] or 0),
+            )
+            proxies = [proxies[i] for i in order]
+        return proxies
+
+
+def probing(profile: Profile) -> bool:
+    """whether the profile is arranged by the probe results"""
+    return config.probe and (profile.drop_unreachable or profile.sort_by_latency)
+
+
+prober = Prober(
+    config.probe_concurrency, config.probe_timeout, config.probe_tls, config.probe_ttl
+)
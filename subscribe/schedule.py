@@ -0,0 +1,123 @@
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.combining import OrTrigger
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from loguru import logger
+
+from config import config
+from subscribe.jobs import jobs, scope
+
+
+def trigger(cron: Optional[str], interval: Optional[int]) -> Optional[BaseTrigger]:
+    triggers: List[BaseTrigger] = []
+    if cron:
+        triggers.append(CronTrigger.from_crontab(cron, config.update_tz))
+    if interval:
+        triggers.append(IntervalTrigger(seconds=interval, timezone=config.update_tz))
+    if len(triggers) > 1:
+        return OrTrigger(triggers)
+    return triggers[0] if triggers else None
+
+
+def refresh_sub(name: str) -> None:
+    jobs.submit(profiles=scope(subs=[name]), subs=[name], rulesets=False)
+
+
+def refresh_profile(name: str) -> None:
+    jobs.submit(profiles=[name], rulesets=False)
+
+
+def refresh_template(name: str) -> None:
+    # the rule providers may have changed as well
+    profiles = [p for p, profile in config.profiles.items() if profile.template == name]
+    jobs.submit(profiles=profiles, subs=[], rulesets=True)
+
+
+def refresh_rulesets() -> None:
+    jobs.submit(profiles=[], subs=[], rulesets=True)
+
+
+class FileWatch:
+    """Polls the mtime / size of the files, calls back the ones changed"""
+
+    def __init__(self) -> None:
+        self.files: Dict[
+            Path, Tuple[Callable[[], None], Optional[Tuple[int, int]]]
+        ] = {}
+
+    @staticmethod
+    def _stat(file: Path) -> Optional[Tuple[int, int]]:
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def add(self, file: Path, callback: Callable[[], None]) -> None:
+        self.files[file] = (callback, self._stat(file))
+
+    async def poll(self) -> None:
+        for file, (callback, last) in self.files.items():
+            current = self._stat(file)
+            if current == last:
+                continue
+            self.files[file] = (callback, current)
+            logger.info(f"{file} is changed")
+            callback()
+
+
+class RefreshScheduler:
+    """
+    Own schedules of the subscribes, profiles and rulesets on top of the global
+    update_cron, each refreshing only its own inputs and the profiles using them.
+    """
+
+    def __init__(self) -> None:
+        self.watch = FileWatch()
+
+    async def _run(self, func: Callable[..., None], *args) -> None:
+        func(*args)
+
+    def _add(self, name: str, trigger: Optional[BaseTrigger], func, *args) -> None:
+        if trigger is None:
+            return
+        logger.info(f"Refresh {name} on {trigger}")
+        self.scheduler.add_job(self._run, trigger, (func, *args))
+
+    def start(self, scheduler: AsyncIOScheduler) -> None:
+        self.scheduler = scheduler
+        for name, sub in config.subscribes.items():
+            self._add(
+                f"subscribe {name}", trigger(sub.cron, sub.interval), refresh_sub, name
+            )
+            if sub.type == "ClashFile" and sub.watch:
+                self.watch.add(Path(sub.file), lambda name=name: refresh_sub(name))
+        for name, profile in config.profiles.items():
+            self._add(
+                f"profile {name}",
+                trigger(profile.cron, profile.interval),
+                refresh_profile,
+                name,
+            )
+        self._add(
+            "rulesets",
+            trigger(config.ruleset_cron, config.ruleset_interval),
+            refresh_rulesets,
+        )
+        if config.watch_templates:
+            for name in dict.fromkeys(p.template for p in config.profiles.values()):
+                self.watch.add(
+                    Path(f"data/template/{name}.yaml"),
+                    lambda name=name: refresh_template(name),
+                )
+        if self.watch.files:
+            self.scheduler.add_job(
+                self.watch.poll, IntervalTrigger(seconds=config.watch_interval)
+            )
+
+
+refresh = RefreshScheduler()
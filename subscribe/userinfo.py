@@ -0,0 +1,88 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from loguru import logger
+
+import metrics
+
+
+class _Entry:
+    __slots__ = ("value", "fetched_at")
+
+    def __init__(self, value: str, fetched_at: float) -> None:
+        self.value = value
+        self.fetched_at = fetched_at
+
+
+class CounterCache:
+    """In-memory subscription-userinfo per profile, refreshed in the background"""
+
+    def __init__(
+        self,
+        fetch: Callable[[str], Awaitable[str]],
+        ttl: int = 300,
+        fallback: bool = True,
+    ) -> None:
+        self.fetch = fetch
+        self.ttl = ttl
+        self.fallback = fallback
+        self._entries: Dict[str, _Entry] = {}
+        self._inflight: Dict[str, "asyncio.Task[str]"] = {}
+
+    def _expired(self, entry: _Entry) -> bool:
+        return time.monotonic() - entry.fetched_at >= self.ttl
+
+    async def _load(self, profile: str) -> str:
+        try:
+            value = await self.fetch(profile)
+        except Exception as e:
+            entry = self._entries.get(profile)
+            if self.fallback and entry is not None:
+                metrics.counter_lookups.inc(result="fallback")
+                logger.warning(
+                    f"Refresh counter of {profile} failed, use the last value: {e}"
+                )
+                value = entry.value
+            else:
+                metrics.counter_lookups.inc(result="error")
+                logger.error(f"Refresh counter of {profile} failed: {e}")
+                value = ""
+            # the failure is kept for the ttl too, the upstream is asked again once
+            # it expires, in the background
+            self._entries[profile] = _Entry(value, time.monotonic())
+            return value
+        metrics.counter_lookups.inc(result="ok")
+        self._entries[profile] = _Entry(value or "", time.monotonic())
+        return value or ""
+
+    def refresh(self, profile: str) -> "asyncio.Task[str]":
+        """start a refresh of the profile, or join the one already running"""
+        task = self._inflight.get(profile)
+        if task is None:
+            task = asyncio.create_task(self._load(profile))
+            self._inflight[profile] = task
+            task.add_done_callback(lambda _: self._inflight.pop(profile, None))
+        return task
+
+    def warm(self, profiles: Iterable[str]) -> None:
+        for profile in profiles:
+            self.refresh(profile)
+
+    def invalidate(self, profile: Optional[str] = None) -> None:
+        if profile is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(profile, None)
+
+    async def get(self, profile: str) -> str:
+        entry = self._entries.get(profile)
+        if entry is None:
+            metrics.cache_misses.inc(cache="counter")
+            # nothing to serve yet, wait for the (shared) upstream call
+            return await asyncio.shield(self.refresh(profile))
+        metrics.cache_hits.inc(cache="counter")
+        if self._expired(entry):
+            # stale-while-revalidate
+            self.refresh(profile)
+        return entry.value
@@ -0,0 +1,7 @@
+import tempfile
+from pathlib import Path
+
+from benchmark import sandbox
+
+# the modules load config.yaml from the working directory as they are imported
+sandbox(workdir=Path(tempfile.mkdtemp(prefix="clashprofile-test-")))
@@ -0,0 +1,41 @@
+import asyncio
+
+from subscribe import UpdateResult
+from subscribe import jobs as jobs_module
+from subscribe.jobs import JobManager
+
+
+def test_merge_into_queued_job(monkeypatch, tmp_path):
+    calls, release = [], None
+
+    async def update(force, profiles, timer, rulesets, subs):
+        calls.append((force, profiles, subs))
+        await release.wait()
+        return UpdateResult(rebuilt=profiles or [])
+
+    monkeypatch.setattr(jobs_module, "update", update)
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        manager = JobManager(tmp_path)
+        first = manager.submit(profiles=["a"])
+        await asyncio.sleep(0)
+        assert first.state == "running"
+
+        # the running job has read its scope already, later triggers wait for the next
+        second = manager.submit(profiles=["b"], trigger="t1")
+        third = manager.submit(profiles=["c"], subs=["s"], force=True)
+        assert third is second and second is not first
+        assert first.profiles == ["a"] and second.profiles == ["b", "c"]
+        assert second.force and second.subs is None and second.triggers == ["t1"]
+        # a follower answers with the id of the trigger it forwarded
+        assert manager.get("t1").id == second.id
+
+        release.set()
+        assert (await manager.wait(second.id)).state == "done"
+        assert first.state == "done"
+        assert calls == [(False, ["a"], None), (True, ["b", "c"], None)]
+        assert manager.get(second.id).result.rebuilt == ["b", "c"]
+
+    asyncio.run(main())
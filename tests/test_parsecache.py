@@ -0,0 +1,64 @@
+import asyncio
+import os
+
+from clash import SS
+from subscribe.parsecache import ParseCache
+
+calls = []
+
+
+def parse(content: bytes):
+    calls.append(content)
+    return [
+        SS(name=name, server="s", port=1, cipher="aes-128-gcm", password="p")
+        for name in content.decode().split()
+    ]
+
+
+def names(proxies):
+    return [proxy.name for proxy in proxies]
+
+
+def test_parse_and_last_good(tmp_path):
+    async def main():
+        cache = ParseCache(tmp_path)
+        assert names(await cache.parse("url", b"a b", parse)) == ["a", "b"]
+        assert names(await cache.parse("url", b"a b", parse)) == ["a", "b"]
+        assert calls == [b"a b"]
+
+        # an empty result is not remembered as the last good one
+        assert await cache.parse("url", b"", parse) == []
+        assert names(await cache.last("url")) == ["a", "b"]
+        # the index survives a restart
+        assert names(await ParseCache(tmp_path).last("url")) == ["a", "b"]
+        assert await cache.last("other") is None
+
+    calls.clear()
+    asyncio.run(main())
+
+
+def test_evict(tmp_path):
+    async def main():
+        cache = ParseCache(tmp_path)
+        for i, content in enumerate([b"a", b"b", b"c", b"d"]):
+            await cache.parse(f"url{i % 2}", content, parse)
+        files = {file.stem: file for file in tmp_path.glob("*.json")}
+        del files["index"]
+        # oldest first: a, b, c, d; the last good ones of url0 / url1 are c and d
+        for age, content in enumerate([b"a", b"b", b"c", b"d"]):
+            file = files[cache.key(content, parse)]
+            os.utime(file, (1000 + age, 1000 + age))
+        size = files[cache.key(b"a", parse)].stat().st_size
+
+        cache.max_size = size * 3
+        cache.evict()
+        left = {file.stem for file in tmp_path.glob("*.json")} - {"index"}
+        assert left == {cache.key(content, parse) for content in (b"b", b"c", b"d")}
+
+        # the last good results are kept even over the limit
+        cache.max_size = 1
+        cache.evict()
+        left = {file.stem for file in tmp_path.glob("*.json")} - {"index"}
+        assert left == {cache.key(content, parse) for content in (b"c", b"d")}
+
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+import base64
+import json
+
+from subscribe import jms, parser
+
+
+def b64(text: str) -> str:
+    return base64.b64encode(text.encode()).decode()
+
+
+def jms_ss(server: str, cipher: str = "aes-256-gcm") -> str:
+    return f"ss://{b64(f'{cipher}:pw@1.2.3.4:443')}#n@{server}:443"
+
+
+def test_quarantine():
+    lines = [
+        jms_ss("c1s1.example.com"),
+        "vmess://!!!broken",
+        jms_ss("c2s2.example.com", cipher="bad-cipher"),
+        "",
+        "hysteria://example.com",
+        "trojan://pw@t.example.com:443?sni=s.example.com#Trojan",
+    ]
+    report = jms.schemes.parse(lines)
+    assert [proxy.name for proxy in report.proxies] == ["JMS-c1s1", "Trojan"]
+    quarantined = sorted((d.index, d.scheme) for d in report.quarantined)
+    assert quarantined == [(2, "vmess"), (3, "ss"), (5, "hysteria")]
+    bad_cipher = next(d for d in report.quarantined if d.index == 3)
+    assert bad_cipher.name == "JMS-c2s2" and "cipher" in bad_cipher.error
+
+
+def test_batches_keep_order(monkeypatch):
+    monkeypatch.setattr(parser, "BATCH_SIZE", 2)
+    lines = [
+        jms_ss(f"s{i}.example.com", "bad" if i % 3 == 1 else "aes-256-gcm")
+        for i in range(7)
+    ]
+    report = jms.schemes.parse(lines)
+    assert [proxy.name for proxy in report.proxies] == [
+        "JMS-s0",
+        "JMS-s2",
+        "JMS-s3",
+        "JMS-s5",
+        "JMS-s6",
+    ]
+    assert sorted(d.index for d in report.quarantined) == [2, 5]
+
+
+def test_schemes():
+    vmess = {
+        "ps": "v",
+        "add": "v.example.com",
+        "port": "443",
+        "id": "u",
+        "aid": 0,
+        "tls": "tls",
+        "net": "ws",
+        "path": "/ws",
+    }
+    ssr = (
+        "1.1.1.1:8080:origin:aes-256-cfb:plain:"
+        + base64.urlsafe_b64encode(b"pw").decode()
+    )
+    sip002 = base64.urlsafe_b64encode(b"aes-128-gcm:pw").decode().rstrip("=")
+    lines = [
+        f"ss://{sip002}@h.example.com:8388#SIP002",
+        f"vmess://{b64(json.dumps(vmess))}",
+        f"ssr://{base64.urlsafe_b64encode(ssr.encode()).decode()}",
+    ]
+    report = parser.schemes.parse(lines)
+    assert not report.quarantined
+    ss, vm, r = (
+        proxy.dict(exclude_none=True, by_alias=True) for proxy in report.proxies
+    )
+    assert (ss["name"], ss["server"], ss["port"], ss["cipher"]) == (
+        "SIP002",
+        "h.example.com",
+        8388,
+        "aes-128-gcm",
+    )
+    assert vm["tls"] is True and vm["ws-opts"] == {"path": "/ws"}
+    assert (r["type"], r["password"], r["protocol"]) == ("ssr", "pw", "origin")
+
+
+def test_parse_items():
+    items = [
+        {
+            "name": "a",
+            "type": "ss",
+            "server": "s",
+            "port": 1,
+            "cipher": "aes-128-gcm",
+            "password": "p",
+        },
+        {
+            "name": "b",
+            "type": "ss",
+            "server": "s",
+            "port": 99999,
+            "cipher": "aes-128-gcm",
+            "password": "p",
+        },
+        "c",
+    ]
+    report = parser.parse_items(items)
+    assert [proxy.name for proxy in report.proxies] == ["a"]
+    assert sorted((d.index, d.name) for d in report.quarantined) == [
+        (2, "b"),
+        (3, None),
+    ]
+
+
+def test_jms_vmess():
+    jms_node = {"ps": "n@c3s3.example.com:443", "port": "443", "id": "u", "aid": 0}
+    plain = {"ps": "Plain", "add": "p.example.com", "port": "80", "id": "u"}
+    lines = [
+        f"vmess://{b64(json.dumps({**jms_node, 'tls': 'none'}))}",
+        f"vmess://{b64(json.dumps(plain))}",
+    ]
+    report = jms.schemes.parse(lines)
+    assert not report.quarantined
+    assert [(proxy.name, proxy.server) for proxy in report.proxies] == [
+        ("JMS-c3s3", "c3s3.example.com"),
+        ("Plain", "p.example.com"),
+    ]
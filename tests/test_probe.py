@@ -0,0 +1,90 @@
+import asyncio
+import socket
+
+from clash import SS, Trojan
+from config import Profile
+from subscribe.probe import Prober
+
+
+def ss(name: str, port: int) -> SS:
+    return SS(
+        name=name, server="127.0.0.1", port=port, cipher="aes-128-gcm", password="p"
+    )
+
+
+def closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def listen() -> asyncio.AbstractServer:
+    async def handle(reader, writer):
+        writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+def test_check():
+    async def main():
+        server = await listen()
+        port = server.sockets[0].getsockname()[1]
+        prober = Prober(timeout=1)
+        async with server:
+            assert await prober.check("127.0.0.1", port) is not None
+        assert await prober.check("127.0.0.1", closed_port()) is None
+
+    asyncio.run(main())
+
+
+def test_tls_handshake_fails_on_plain_listener():
+    async def main():
+        server = await listen()
+        port = server.sockets[0].getsockname()[1]
+        trojan = Trojan(name="t", server="127.0.0.1", port=port, password="p")
+        async with server:
+            assert await Prober(timeout=1).check("127.0.0.1", port) is not None
+            prober = Prober(timeout=1, tls=True)
+            await prober.probe([trojan])
+            assert prober.latency(trojan) is None
+
+    asyncio.run(main())
+
+
+def test_probe_is_cached():
+    async def main():
+        server = await listen()
+        proxy = ss("a", server.sockets[0].getsockname()[1])
+        cached, uncached = Prober(timeout=1, ttl=600), Prober(timeout=1, ttl=0)
+        async with server:
+            await cached.probe([proxy])
+            await uncached.probe([proxy])
+        await cached.probe([proxy])
+        await uncached.probe([proxy])
+        assert cached.latency(proxy) is not None
+        assert uncached.latency(proxy) is None
+
+    asyncio.run(main())
+
+
+def test_arrange():
+    async def main():
+        server = await listen()
+        port = server.sockets[0].getsockname()[1]
+        dead, alive = ss("dead", closed_port()), ss("alive", port)
+        prober = Prober(timeout=1)
+        async with server:
+            await prober.probe([dead, alive])
+        return prober, dead, alive
+
+    prober, dead, alive = asyncio.run(main())
+    profile = Profile(template="blacklist")
+    assert prober.arrange([dead, alive], profile) == [dead, alive]
+
+    profile = Profile(template="blacklist", sort_by_latency=True)
+    assert prober.arrange([dead, alive], profile) == [alive, dead]
+
+    profile = Profile(template="blacklist", drop_unreachable=True)
+    assert prober.arrange([dead, alive], profile) == [alive]
+    # nothing reachable, the probe is more likely broken than every server
+    assert prober.arrange([dead], profile) == [dead]
@@ -0,0 +1,84 @@
+from pathlib import Path
+
+import pytest
+from pydantic import ValidationError
+
+import serializer
+from clash import SS, ClashTemplate, Trojan
+from clash.proxygroup import ProxyFilter
+
+STATIC = Path(__file__).resolve().parent.parent / "static" / "template"
+
+PROXIES = [
+    SS(
+        name="HK 01",
+        server="hk1.Example.com",
+        port=1,
+        cipher="aes-128-gcm",
+        password="p",
+    ),
+    SS(
+        name="JP 01",
+        server="jp1.example.net",
+        port=1,
+        cipher="aes-128-gcm",
+        password="p",
+    ),
+    Trojan(name="HK 02 x2", server="hk2.example.com", port=443, password="p"),
+]
+SOURCES = ["A", "A", "B"]
+
+
+def matches(proxy_filter: ProxyFilter):
+    return [p.name for p, s in zip(PROXIES, SOURCES) if proxy_filter.match(p, s)]
+
+
+def test_filter():
+    assert matches(ProxyFilter(name="^HK")) == ["HK 01", "HK 02 x2"]
+    assert matches(ProxyFilter(name="^HK", exclude="x2")) == ["HK 01"]
+    assert matches(ProxyFilter(type="trojan")) == ["HK 02 x2"]
+    assert matches(ProxyFilter(server=["EXAMPLE.com"])) == ["HK 01", "HK 02 x2"]
+    assert matches(ProxyFilter(sub="A", server=".net")) == ["JP 01"]
+    with pytest.raises(ValidationError):
+        ProxyFilter(country="HK")
+
+
+def template(*groups) -> ClashTemplate:
+    data = serializer.load((STATIC / "whitelist.yml").read_bytes())
+    data["proxy-groups"] += list(groups)
+    return ClashTemplate.parse_obj(data)
+
+
+def test_render():
+    clash = template(
+        {
+            "name": "HK",
+            "type": "select",
+            "proxies": "__proxies_name_list__",
+            "filter": {"name": "^HK"},
+        },
+        {
+            "name": "US",
+            "type": "select",
+            "proxies": "__proxies_name_list__",
+            "filter": {"name": "^US"},
+        },
+    ).render(PROXIES, top=2, sources=SOURCES)
+    groups = {group.name: group.proxies for group in clash.proxy_groups}
+    assert groups["HK"] == ["HK 01", "HK 02 x2"]
+    assert groups["🚀 手动切换"] == ["HK 01", "JP 01"]
+    # a filter matching nothing falls back to DIRECT instead of an empty group
+    assert groups["US"] == ["DIRECT"]
+    assert all("filter" not in group.dict() for group in clash.proxy_groups)
+
+
+def test_filter_needs_name_list():
+    with pytest.raises(ValidationError):
+        template(
+            {
+                "name": "HK",
+                "type": "select",
+                "proxies": ["DIRECT"],
+                "filter": {"name": "^HK"},
+            }
+        )
@@ -0,0 +1,46 @@
+import time
+from email.utils import formatdate
+
+import retry
+from retry import CircuitBreaker, RetryPolicy
+
+
+def test_delay(monkeypatch):
+    policy = RetryPolicy(3, base=1, cap=5)
+    monkeypatch.setattr(retry.random, "uniform", lambda low, high: high)
+    assert [policy.delay(attempt) for attempt in range(5)] == [1, 2, 4, 5, 5]
+    assert policy.delay(0, retry_after=3) == 3
+    assert policy.delay(0, retry_after=60) == 5
+    assert RetryPolicy(0, 1, 5).retries == 1
+
+
+def test_retry_after():
+    assert RetryPolicy.retry_after(None) is None
+    assert RetryPolicy.retry_after("120") == 120
+    assert 55 < RetryPolicy.retry_after(formatdate(time.time() + 60, usegmt=True)) <= 60
+    assert RetryPolicy.retry_after(formatdate(time.time() - 60, usegmt=True)) == 0
+    assert RetryPolicy.retry_after("soon") is None
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retry.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(threshold=2, cooldown=30)
+    breaker.failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    now[0] += 30
+    assert breaker.state == "half-open"
+    # one probe goes through, the others fail fast until it reports back
+    assert breaker.allow() and not breaker.allow()
+    now[0] += 30
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed" and breaker.failures == 0
+
+    disabled = CircuitBreaker(threshold=0, cooldown=30)
+    for _ in range(10):
+        disabled.failure()
+    assert disabled.allow()
@@ -0,0 +1,121 @@
+import asyncio
+import gzip
+from datetime import datetime, timedelta
+
+import pytest
+from apscheduler.triggers.cron import CronTrigger
+from pytz import timezone
+from starlette.requests import Request
+
+from config import config
+from serve import (
+    Payload,
+    ProviderCache,
+    RulesetSchedule,
+    negotiate,
+    not_modified,
+    parse_range,
+    respond,
+    respond_file,
+)
+from storage import precompress, storage
+
+
+def request(**headers: str) -> Request:
+    raw = [
+        (key.replace("_", "-").encode(), value.encode())
+        for key, value in headers.items()
+    ]
+    return Request({"type": "http", "method": "GET", "headers": raw})
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    assert parse_range("items=0-1", 100) is None
+    assert parse_range("bytes=a-b", 100) is None
+    for header in ("bytes=100-", "bytes=5-4", "bytes=-0"):
+        with pytest.raises(ValueError):
+            parse_range(header, 100)
+
+
+def test_provider_file():
+    file = storage.provider("test-serve")
+    file.parent.mkdir(parents=True, exist_ok=True)
+    file.write_bytes(b"payload:\n  - DOMAIN,example.com\n")
+    precompress(file)
+
+    async def main():
+        cache = ProviderCache()
+        provider = await cache.get("test-serve")
+        assert await cache.get("test-serve") is provider
+        assert "gzip" in provider.paths
+
+        resp = await respond_file(request(range="bytes=0-7"), provider)
+        assert (resp.status_code, resp.body) == (206, b"payload:")
+        assert resp.headers["content-range"] == f"bytes 0-7/{file.stat().st_size}"
+
+        etag = provider.etags["gzip"]
+        resp = await respond_file(
+            request(accept_encoding="gzip", if_none_match=etag), provider
+        )
+        assert resp.status_code == 304
+
+        # the variants left from the previous version are not served
+        file.write_bytes(b"payload: []\n")
+        provider = await cache.get("test-serve")
+        assert list(provider.paths) == ["identity"]
+        assert provider.etags["identity"] != etag
+
+    asyncio.run(main())
+
+
+def test_ruleset_schedule(monkeypatch):
+    calls = []
+    from_crontab = CronTrigger.from_crontab
+
+    def counting(expr, timezone=None):
+        calls.append(expr)
+        return from_crontab(expr, timezone)
+
+    monkeypatch.setattr(CronTrigger, "from_crontab", counting)
+    monkeypatch.setattr(config, "update_cron", "0 * * * *")
+    monkeypatch.setattr(config, "ruleset_cron", None)
+    schedule = RulesetSchedule()
+    now = timezone(config.update_tz).localize(datetime(2022, 11, 1, 10, 30))
+    fire = schedule.next_fire(now)
+    assert fire == now.replace(hour=11, minute=0)
+    assert schedule.next_fire(now + timedelta(minutes=10)) is fire
+    assert schedule.next_fire(fire + timedelta(seconds=1)) == fire + timedelta(hours=1)
+    assert calls == ["0 * * * *"]
+
+
+def test_negotiate():
+    available = ["identity", "gzip", "br"]
+    assert negotiate("gzip, deflate, br", available) == "br"
+    assert negotiate("gzip, br;q=0", available) == "gzip"
+    assert negotiate("*", ["identity", "gzip"]) == "gzip"
+    assert negotiate("", available) == "identity"
+    assert negotiate("br;q=bogus, gzip", available) == "gzip"
+
+
+def test_not_modified():
+    assert not_modified('"a", W/"b"', '"b"')
+    assert not_modified("*", '"b"')
+    assert not not_modified('"a"', '"b"')
+    assert not not_modified(None, '"b"')
+
+
+def test_respond_payload():
+    payload = Payload(b"proxies: []\n" * 100, 0)
+    resp = respond(request(accept_encoding="gzip"), payload, {"x-extra": "1"})
+    assert resp.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(resp.body) == payload.bodies["identity"]
+    assert resp.headers["etag"] == f'"{payload.digest}-gzip"'
+    assert resp.headers["x-extra"] == "1"
+
+    resp = respond(request(if_none_match=payload.etags["identity"]), payload)
+    assert resp.status_code == 304 and not resp.body
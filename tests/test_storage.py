@@ -0,0 +1,67 @@
+import pytest
+
+import storage as storage_module
+from storage import Storage, atomic_write
+
+
+@pytest.fixture
+def data(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage_module, "DATA_PATH", tmp_path)
+    monkeypatch.setattr(storage_module, "GENERATIONS_PATH", tmp_path / "generations")
+    monkeypatch.setattr(storage_module, "CURRENT_POINTER", tmp_path / "current")
+    monkeypatch.setattr(storage_module, "VERSION_STAMP", tmp_path / "version")
+    return tmp_path
+
+
+def test_unversioned(data):
+    storage = Storage(0)
+    gen = storage.begin()
+    assert gen.root == data and not gen.versioned
+    gen.profile("p").write_text("v1")
+    storage.commit(gen)
+    assert storage.profile("p").read_text() == "v1"
+    assert not (data / "current").exists()
+
+
+def test_generations(data):
+    storage, commits = Storage(2), []
+    storage.on_commit(lambda: commits.append(storage.current()))
+
+    gen = storage.begin()
+    gen.profile("p").write_text("v1")
+    gen.provider("r").write_text("rules")
+    # nothing is visible before the commit
+    assert not storage.profile("p").exists()
+    storage.commit(gen)
+    assert storage.profile("p").read_text() == "v1"
+    assert commits == [gen.root.name]
+
+    # a new generation starts from the current files, untouched ones carry over
+    second = storage.begin()
+    # the carried over files are hard links, they must be replaced, never rewritten
+    atomic_write(second.profile("p"), b"v2")
+    assert storage.profile("p").read_text() == "v1"
+    storage.commit(second)
+    assert storage.profile("p").read_text() == "v2"
+    assert storage.provider("r").read_text() == "rules"
+
+    failed = storage.begin()
+    storage.discard(failed)
+    assert not failed.root.exists()
+    assert storage.current() == second.root.name
+
+    third = storage.begin()
+    storage.commit(third)
+    # only the last two generations are kept
+    assert sorted(p.name for p in (data / "generations").iterdir()) == [
+        second.root.name,
+        third.root.name,
+    ]
+    assert len(commits) == 3 and storage.version == 3
+
+
+def test_sync(data):
+    leader, follower = Storage(0), Storage(0)
+    assert not follower.sync()
+    leader.commit(leader.begin())
+    assert follower.sync() and not follower.sync()
@@ -0,0 +1,24 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+from clash import TemplateRegistry
+
+STATIC = Path(__file__).resolve().parent.parent / "static" / "template"
+
+
+def test_load_digest(tmp_path):
+    registry = TemplateRegistry(tmp_path)
+    file = tmp_path / "t.yaml"
+    shutil.copy(STATIC / "whitelist.yml", file)
+    template, digest = registry.load("t")
+    assert digest == hashlib.sha256(file.read_bytes()).hexdigest()
+    assert registry.load("t") == (template, digest)
+
+    stat = file.stat()
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert registry.load("t") == (template, digest)
+
+    file.write_bytes(file.read_bytes() + b"\n# changed\n")
+    assert registry.load("t")[1] == hashlib.sha256(file.read_bytes()).hexdigest()
@@ -0,0 +1,48 @@
+import asyncio
+
+from subscribe.userinfo import CounterCache
+
+
+def test_failure_is_cached():
+    calls = []
+
+    async def fetch(profile: str) -> str:
+        calls.append(profile)
+        raise OSError("upstream down")
+
+    async def main():
+        cache = CounterCache(fetch, ttl=60)
+        assert await cache.get("p") == ""
+        assert await cache.get("p") == ""
+        assert calls == ["p"]
+
+        # expired: the stale value is served while the refresh runs
+        cache.ttl = 0
+        assert await cache.get("p") == ""
+        await asyncio.sleep(0)
+        assert calls == ["p", "p"]
+
+    asyncio.run(main())
+
+
+def test_fallback():
+    values = ["upload=0; download=1", OSError("upstream down")]
+
+    async def fetch(profile: str) -> str:
+        value = values.pop(0)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    async def main():
+        cache = CounterCache(fetch, ttl=0)
+        assert await cache.get("p") == "upload=0; download=1"
+        assert await cache.refresh("p") == "upload=0; download=1"
+        assert await cache.get("p") == "upload=0; download=1"
+
+        cache = CounterCache(fetch, ttl=0, fallback=False)
+        values[:] = ["upload=0; download=1", OSError("upstream down")]
+        await cache.get("p")
+        assert await cache.refresh("p") == ""
+
+    asyncio.run(main())
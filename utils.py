@@ -1,40 +1,354 @@
 import asyncio
+import hashlib
+import json
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
 
-from httpx import AsyncClient
+from httpx import AsyncClient, HTTPError, Response
 from loguru import logger
 
+import metrics
+from client import client_manager
 from config import config
+from retry import (
+    RETRY_STATUS,
+    CircuitOpen,
+    DownloadError,
+    RetryableStatus,
+    hosts,
+    policy,
+)
+from storage import CHUNK_SIZE, Generation, atomic_open, atomic_write, precompress
+
+CACHE_PATH = Path("data/cache")
+T = TypeVar("T")
+
+_executor: Optional[Executor] = None
+
+
+def executor() -> Executor:
+    """pool for the CPU-heavy parse / render / dump work"""
+    global _executor
+    if _executor is None:
+        if config.render_executor == "process":
+            _executor = ProcessPoolExecutor(config.render_workers)
+        else:
+            _executor = ThreadPoolExecutor(config.render_workers)
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+async def run_sync(func: Callable[..., T], *args, **kwargs) -> T:
+    """run func in the executor without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(
+        executor(), partial(func, *args, **kwargs)
+    )
+
+
+class Timer:
+    """wall time of the (possibly overlapping) stages of a run"""
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.running: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = self.running[name] = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - start
+            del self.running[name]
+
+    def progress(self) -> Dict[str, Dict]:
+        """state and seconds spent so far of every stage started"""
+        now = time.perf_counter()
+        progress = {
+            name: {"state": "running", "seconds": now - start}
+            for name, start in self.running.items()
+        }
+        for name, cost in self.stages.items():
+            progress[name] = {"state": "done", "seconds": cost}
+        return progress
+
+    def dict(self) -> Dict[str, float]:
+        return dict(self.stages, total=time.perf_counter() - self.start)
+
+    def __str__(self) -> str:
+        return ", ".join(f"{name} {cost:.3f}s" for name, cost in self.dict().items())
+
+
+class TooLarge(Exception):
+    """the body is larger than the max size allowed for the url"""
+
+
+class _Unchanged(Exception):
+    pass
+
+
+class Validators:
+    """Sidecar store of ETag / Last-Modified / content hash per url"""
+
+    def __init__(self, file: Path = CACHE_PATH / "validators.json") -> None:
+        self.file = file
+        try:
+            self.data: Dict[str, Dict] = json.loads(file.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            self.data = {}
+
+    def get(self, url: str) -> Dict:
+        return self.data.get(url, {})
+
+    def set(self, url: str, res: Response, sha256: str, size: int) -> None:
+        self.data[url] = {
+            "etag": res.headers.get("etag"),
+            "last_modified": res.headers.get("last-modified"),
+            "sha256": sha256,
+            "size": size,
+        }
+
+    def headers(self, url: str) -> Dict[str, str]:
+        meta, headers = self.get(url), {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def save(self) -> None:
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.file, json.dumps(self.data, indent=2).encode())
+
+
+class DownloadStats:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+        self.files_written = 0
+        self.files_skipped = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.requests} requests, {self.not_modified} not modified, "
+            f"{self.bytes_downloaded} bytes downloaded, "
+            f"{self.bytes_saved} bytes saved, "
+            f"{self.files_written} files written, {self.files_skipped} files skipped"
+        )
 
 
 class Download:
     def __init__(self) -> None:
-        self.client = AsyncClient()
         self.sem = asyncio.Semaphore(config.download_sem)
+        self.stats = DownloadStats()
+        self._validators: Optional[Validators] = None
+
+    @property
+    def validators(self) -> Validators:
+        if self._validators is None:
+            self._validators = Validators()
+        return self._validators
 
-    async def content(self, url: str) -> bytes:
-        async with self.sem:
-            for count in range(config.download_retry):
-                try:
-                    res = await self.client.get(url, timeout=60)
-                    return res.content
-                except Exception as e:
-                    logger.error(f"[{count+1}] get {url} failed: {e}")
-            logger.error(
-                f"[{count+1}] {url} has reached the maximum retries, stop retries"
+    @property
+    def client(self) -> AsyncClient:
+        return client_manager.client
+
+    @staticmethod
+    def _check(res: Response) -> None:
+        if res.status_code in RETRY_STATUS:
+            raise RetryableStatus(
+                res.status_code, policy.retry_after(res.headers.get("retry-after"))
             )
-            return b""
 
-    async def provider(self, rulesets) -> None:
+    async def attempt(
+        self, url: str, func: Callable[[], Awaitable[T]], kind: str = "other"
+    ) -> T:
+        """
+        Call func until it gets through, backing off between the attempts. The
+        semaphores are only held during an attempt, raise DownloadError on giving up.
+        `kind` labels the latency metrics: subscription, ruleset or counter.
+        """
+        host = hosts.host(url)
+        breaker, stat = hosts.breaker(host), hosts.stat(host)
+        for count in range(policy.retries):
+            if not breaker.allow():
+                stat.rejected += 1
+                raise CircuitOpen(f"{host} is down, skip {url}")
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                async with self.sem, client_manager.host_sem(url):
+                    result = await func()
+            except RetryableStatus as e:
+                error, retry_after = e, e.retry_after
+            except HTTPError as e:
+                error = e
+            except Exception:
+                # the host answered, whatever the caller thinks of the answer
+                breaker.success()
+                stat.success(self._observe(host, kind, start))
+                raise
+            else:
+                breaker.success()
+                stat.success(self._observe(host, kind, start))
+                return result
+            breaker.failure()
+            stat.failures += 1
+            self._observe(host, kind, start)
+            metrics.upstream_fetch_failures.inc(host=host, kind=kind)
+            logger.error(f"[{count+1}] get {url} failed: {error!r}")
+            if count + 1 < policy.retries:
+                await asyncio.sleep(policy.delay(count, retry_after))
+        raise DownloadError(f"{url} has reached the maximum retries, stop retries")
+
+    @staticmethod
+    def _observe(host: str, kind: str, start: float) -> float:
+        latency = time.perf_counter() - start
+        metrics.upstream_fetch_seconds.observe(latency, host=host, kind=kind)
+        return latency
+
+    async def request(
+        self, url: str, headers: Optional[Dict[str, str]] = None, kind: str = "other"
+    ) -> Response:
+        async def get() -> Response:
+            res = await self.client.get(url, headers=headers)
+            self._check(res)
+            return res
+
+        res = await self.attempt(url, get, kind)
+        self.stats.requests += 1
+        self.stats.bytes_downloaded += len(res.content)
+        return res
+
+    async def content(self, url: str, kind: str = "other") -> bytes:
+        return (await self.request(url, kind=kind)).content
+
+    async def conditional(self, url: str, cached: bool = True) -> Optional[bytes]:
+        """
+        Conditional GET of url, return None if the content is the same as the last
+        download, `cached` means the last content is still available locally.
+        """
+        meta = self.validators.get(url) if cached else {}
+        res = await self.request(
+            url, self.validators.headers(url) if cached else None, "subscription"
+        )
+        if res.status_code == 304 and meta:
+            metrics.cache_hits.inc(cache="upstream")
+            self.stats.not_modified += 1
+            self.stats.bytes_saved += meta.get("size", 0)
+            logger.debug(f"{url} is not modified")
+            return None
+        if not res.is_success:
+            raise DownloadError(f"get {url} failed: HTTP {res.status_code}")
+        content = res.content
+        sha256 = hashlib.sha256(content).hexdigest()
+        self.validators.set(url, res, sha256, len(content))
+        if meta.get("sha256") == sha256:
+            metrics.cache_hits.inc(cache="upstream")
+            logger.debug(f"{url} is unchanged")
+            return None
+        metrics.cache_misses.inc(cache="upstream")
+        return content
+
+    @staticmethod
+    def max_size(url: str) -> int:
+        return config.download_max_sizes.get(url, config.download_max_size)
+
+    async def stream_to_file(self, url: str, file: Path, header: bytes = b"") -> bool:
+        """
+        Stream url into file chunk by chunk, return whether the file is replaced.
+        The old file is kept if the server answers 304, the body is unchanged, the
+        download fails or the body is larger than the max size of the url.
+        """
+        meta = self.validators.get(url) if file.exists() else {}
+        headers = self.validators.headers(url) if meta else None
+        limit = self.max_size(url)
+
+        async def stream() -> bool:
+            async with self.client.stream("GET", url, headers=headers) as res:
+                self._check(res)
+                self.stats.requests += 1
+                if res.status_code == 304 and meta:
+                    metrics.cache_hits.inc(cache="upstream")
+                    self.stats.not_modified += 1
+                    self.stats.bytes_saved += meta.get("size", 0)
+                    logger.debug(f"{url} is not modified")
+                    return False
+                if not res.is_success:
+                    logger.error(f"get {url} failed: HTTP {res.status_code}")
+                    return False
+                if limit and int(res.headers.get("content-length") or 0) > limit:
+                    raise TooLarge(f"{url} is larger than {limit} bytes")
+
+                sha256, size = hashlib.sha256(), 0
+                with atomic_open(file) as f:
+                    f.write(header)
+                    async for chunk in res.aiter_bytes(CHUNK_SIZE):
+                        size += len(chunk)
+                        self.stats.bytes_downloaded += len(chunk)
+                        if limit and size > limit:
+                            raise TooLarge(f"{url} is larger than {limit} bytes")
+                        sha256.update(chunk)
+                        f.write(chunk)
+                    self.validators.set(url, res, sha256.hexdigest(), size)
+                    if meta.get("sha256") == sha256.hexdigest():
+                        metrics.cache_hits.inc(cache="upstream")
+                        raise _Unchanged
+                metrics.cache_misses.inc(cache="upstream")
+                return True
+
+        try:
+            return await self.attempt(url, stream, "ruleset")
+        except _Unchanged:
+            logger.debug(f"{url} is unchanged")
+        except (TooLarge, DownloadError) as e:
+            logger.error(e)
+        return False
+
+    async def subscription(self, url: str) -> bytes:
+        """download a subscription, reuse the last body if it's not modified"""
+        body = CACHE_PATH / "body" / hashlib.sha1(url.encode()).hexdigest()
+        try:
+            content = await self.conditional(url, body.exists())
+        except DownloadError as e:
+            if not body.exists():
+                raise
+            logger.warning(f"{e}, use the last downloaded content")
+            content = None
+        if content is None:
+            return body.read_bytes() if body.exists() else b""
+        atomic_write(body, content)
+        # the validators are only of use next to the body they describe
+        self.validators.save()
+        return content
+
+    async def provider(self, rulesets, gen: Generation) -> None:
         async def download_and_write(name: str, url: str):
 
             logger.debug(f"downloading ruleset: {name}")
-            bfile = await self.content(url)
+            file = gen.provider(name)
 
-            if bfile:
-                with open(f"data/provider/{name}.yaml", "wb") as f:
-                    f.write(updatetime.encode())
-                    f.write(bfile)
+            if await self.stream_to_file(url, file, updatetime.encode()):
+                self.stats.files_written += 1
+            else:
+                self.stats.files_skipped += 1
+                if not file.exists() or file.with_name(file.name + ".gz").exists():
+                    return
+            await run_sync(precompress, file)
 
         tasks = []
         logger.info("Start downloading rulesets")
@@ -43,4 +357,5 @@ class Download:
             url = rulesets[name]
             tasks.append(asyncio.create_task(download_and_write(name, url)))
         await asyncio.gather(*tasks)
-
+        self.validators.save()
+        logger.info(f"Download stats: {self.stats}")